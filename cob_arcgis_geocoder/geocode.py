@@ -1,6 +1,11 @@
+import numpy as np
 import pandas as pd 
 import urllib.parse
+import urllib.request
 import json
+import gzip
+import re
+import hashlib
 from pandas.io.json import json_normalize
 import psycopg2
 import subprocess
@@ -8,75 +13,206 @@ import os
 import codecs
 from collections import OrderedDict
 import sys
-from datetime import datetime
+import sqlite3
+from datetime import datetime, timedelta
+from cob_arcgis_geocoder.profiling import Profiler
+
+# base url of the geocode service, set ARCGIS_GEOCODER_URL to use another server such as scripts/stub_server.py
+GEOCODER_URL = os.environ.get("ARCGIS_GEOCODER_URL", "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer")
+
+# attributes requested for each candidate, address, score and location are always returned
+LEAN_OUTPUT_FIELDS = "Ref_ID,Loc_name"
 
 class CobArcGISGeocoder(object):
 
-    def __init__(self, df, address_field):
+    def __init__(self, df, address_field, negative_cache=None, negative_cache_ttl=7):
         # initiate dataframe with new columns to be populated
         self.df = df 
         self.address_field = address_field
+        # sqlite file of addresses that returned no candidates or a 400 error, skipped until negative_cache_ttl days pass
+        self.negative_cache = _NegativeCache(negative_cache, negative_cache_ttl) if negative_cache is not None else None
 
-    def geocode_df(self):
-        
-        # add columns for geocoded address information
-        df = pd.concat([self.df,pd.DataFrame(columns=["matched_address", "matched_address_score", "SAM_ID", "location_x", "location_y", "flag", "locator_name"])])
+    def geocode_df(self, inplace=False, columns_only=False, previous=None, profile=None):
+        """Returns the dataframe with the geocoded address information added.
+
+        With inplace or columns_only only the result columns are allocated, with compact dtypes: float64 for the score
+        and coordinates, a nullable integer SAM_ID and categorical flag and locator_name columns. The default output
+        keeps the object dtype result columns it has always had.
+
+        Args:
+            inplace (bool, optional): Add the result columns to the input dataframe instead of returning a copy of it.
+            columns_only (bool, optional): Return only the result columns, indexed like the input dataframe.
+            previous (:obj:`dataframe`, optional): Output of a previous run. Rows whose normalized address was geocoded
+                in it are carried forward, only new, changed or previously failed addresses are sent to ArcGIS.
+            profile (str, optional): Path prefix to write cProfile stats, collapsed stacks and a hot function summary to.
+
+        Returns:
+            dataframe: The input with the result columns, or only the result columns if columns_only is True.
+            none: If inplace is True.
+        """
+
+        if profile is not None:
+            with Profiler(profile):
+                return self.geocode_df(inplace, columns_only, previous)
+
+        row_count = len(self.df.index)
+
+        # previously geocoded results keyed by the hash of the normalized address
+        previous_results = self._previous_results(previous, self.address_field) if previous is not None else dict()
+        self.rows_reused = 0
+        self.rows_requested = 0
+
+        # arrays for the geocoded address information, filled in by position
+        matched_address = np.full(row_count, None, dtype=object)
+        matched_address_score = np.full(row_count, np.nan)
+        # SAM IDs are kept as returned, so a Ref_ID that isn't a number doesn't stop the run
+        SAM_ID = np.full(row_count, None, dtype=object)
+        location_x = np.full(row_count, np.nan)
+        location_y = np.full(row_count, np.nan)
+        flag = np.full(row_count, None, dtype=object)
+        locator_name = np.full(row_count, None, dtype=object)
         
         # Locators that return addresses with SAM IDs
         SAM_Locators = ["SAM_Sub_Unit_A", "SAM_Alternate"]
 
-        # Iterate through each row and geocode the address
-        for index, row in df.iterrows():
+        # Iterate through each address and geocode it
+        for position, address in enumerate(self.df[self.address_field]):
+
+            previous_result = previous_results.get(self._address_hash(address)) if previous_results and address is not None else None
+            known_failure = self.negative_cache.get(address) if self.negative_cache is not None and address is not None and previous_result is None else None
             
-            if row[self.address_field] is None: 
+            if address is None: 
                 # if address field is empty, add flag to row
-                df.at[index, "flag"] = "No address provided. Unable to geocode."
+                flag[position] = "No address provided. Unable to geocode."
+            elif previous_result is not None:
+                # if the address was geocoded in the previous output, carry the result forward
+                (matched_address[position], matched_address_score[position], SAM_ID[position], location_x[position],
+                 location_y[position], flag[position], locator_name[position]) = previous_result
+                self.rows_reused += 1
+            elif known_failure is not None:
+                # if the address recently failed to geocode, flag it without sending it to ArcGIS again
+                flag[position] = "Unable to geocode to any address."
+                location_x[position] = 0.00
+                location_y[position] = 0.00
             else: 
+                self.rows_requested += 1
                 # if address field isn't empty, try geocoding:
                 # 1. find the address candidates
-                candidates = self._find_address_candidates(SingleLine=row[self.address_field])
+                candidates = self._find_address_candidates(SingleLine=address)
                 # 2. pick the from the list of candidates
                 matched_address_df = self._pick_address_candidate(candidates, SAM_Locators)  
 
                 if matched_address_df is not None and matched_address_df[["flag"]][0] == "Able to geocode to a SAM address.": 
-                    # if able to pick an address, update the row in the dataframe with the geocoded address information
-                    df.at[index, "matched_address"] = matched_address_df[["address"]][0]
-                    df.at[index, "matched_address_score"] = matched_address_df[["score"]][0]
-                    df.at[index, "SAM_ID"] = matched_address_df[["attributes.Ref_ID"]][0]
-                    df.at[index, "location_x"] = matched_address_df[["location.x"]][0]
-                    df.at[index, "location_y"] = matched_address_df[["location.y"]][0]
-                    df.at[index, "flag"] = matched_address_df[["flag"]][0]
-                    df.at[index, "locator_name"] = matched_address_df[["attributes.Loc_name"]][0]
+                    # if able to pick an address, update the row with the geocoded address information
+                    matched_address[position] = matched_address_df[["address"]][0]
+                    matched_address_score[position] = matched_address_df[["score"]][0]
+                    SAM_ID[position] = matched_address_df[["attributes.Ref_ID"]][0]
+                    location_x[position] = matched_address_df[["location.x"]][0]
+                    location_y[position] = matched_address_df[["location.y"]][0]
+                    flag[position] = matched_address_df[["flag"]][0]
+                    locator_name[position] = matched_address_df[["attributes.Loc_name"]][0]
                 elif matched_address_df is not None and matched_address_df[["flag"]][0] == "Able to geocode to a non-SAM address.":
-                    df.at[index, "matched_address"] = matched_address_df[["address"]][0]
-                    df.at[index, "matched_address_score"] = matched_address_df[["score"]][0]
-                    df.at[index, "location_x"] = matched_address_df[["location.x"]][0]
-                    df.at[index, "location_y"] = matched_address_df[["location.y"]][0]
-                    df.at[index, "flag"] = matched_address_df[["flag"]][0]
-                    df.at[index, "locator_name"] = matched_address_df[["attributes.Loc_name"]][0]
-                    self._archive_non_sam_address(row[self.address_field], matched_address_df[["address"]][0])
+                    matched_address[position] = matched_address_df[["address"]][0]
+                    matched_address_score[position] = matched_address_df[["score"]][0]
+                    location_x[position] = matched_address_df[["location.x"]][0]
+                    location_y[position] = matched_address_df[["location.y"]][0]
+                    flag[position] = matched_address_df[["flag"]][0]
+                    locator_name[position] = matched_address_df[["attributes.Loc_name"]][0]
+                    self._archive_non_sam_address(address, matched_address_df[["address"]][0])
                 else:
-                    # if unable to find an address to geocode to, flag the row in the dataframe
-                    df.at[index, "flag"] = "Unable to geocode to any address."
+                    # if unable to find an address to geocode to, flag the row
+                    flag[position] = "Unable to geocode to any address."
                     # Set lat/long to 0 if unable to geocode
-                    df.at[index, "location_x"] = 0.00
-                    df.at[index, "location_y"] = 0.00      
-                    self._archive_non_sam_address(row[self.address_field], None)
+                    location_x[position] = 0.00
+                    location_y[position] = 0.00      
+                    # errors that may pass, like an overloaded server, aren't cached so the address is tried again next run
+                    returned_result = self._failure_result(candidates)
+                    if self.negative_cache is None or returned_result is None:
+                        self._archive_non_sam_address(address, None)
+                    # only archive the address again if it failed differently or wasn't archived the last time it was recorded
+                    elif self.negative_cache.put(address, returned_result) and self._archive_non_sam_address(address, None):
+                        self.negative_cache.mark_archived(address)
+
+        if previous is not None:
+            print("Reused {} rows from the previous output and requested {} rows.".format(self.rows_reused, self.rows_requested))
+
+        if not inplace and not columns_only:
+            # the default output is a copy of the input with object result columns, so callers can still assign any
+            # value to them, replacing input columns of the same name
+            df = self.df.copy()
+            for column, values in [("matched_address", matched_address), ("matched_address_score", matched_address_score),
+                                   ("SAM_ID", SAM_ID), ("location_x", location_x), ("location_y", location_y),
+                                   ("flag", flag), ("locator_name", locator_name)]:
+                df[column] = pd.Series(np.array([np.nan if pd.isnull(value) else value for value in values], dtype=object), index=df.index)
+            return df
 
-        # return the updated dataframe when the rows have been iterated through
-        return df
+        results = pd.DataFrame(OrderedDict([("matched_address", matched_address),
+                                            ("matched_address_score", matched_address_score),
+                                            ("SAM_ID", self._nullable_ids(SAM_ID)),
+                                            ("location_x", location_x),
+                                            ("location_y", location_y),
+                                            ("flag", pd.Categorical(flag)),
+                                            ("locator_name", pd.Categorical(locator_name))]),
+                               index=self.df.index)
+
+        if columns_only:
+            return results
+
+        # only the result columns are allocated, the existing columns are left where they are
+        for column in results.columns:
+            self.df[column] = results[column]
+        return None
+
+    @staticmethod
+    def _nullable_ids(values):
+        """Returns the SAM IDs as a nullable integer array, or as they are if any of them isn't a whole number."""
+
+        try:
+            return pd.array(values, dtype="Int64")
+        except (TypeError, ValueError):
+            return values
    
+    @staticmethod
+    def _address_hash(address):
+        """Returns a hash of the address after normalizing its case, whitespace and punctuation."""
+
+        normalized = " ".join(re.sub(r"[^\w\s]", " ", str(address)).upper().split())
+        return hashlib.sha1(normalized.encode("utf-8")).digest()
+
+    @classmethod
+    def _previous_results(self, previous, address_field):
+        """Returns the results of a previous geocoded output keyed by address hash.
+
+        Args:
+            previous (:obj:`dataframe`): Output of a previous run of geocode_df.
+            address_field (str): Name of the column holding the addresses.
+
+        Returns:
+            dict: Tuples of the result columns for each address that was geocoded. Failed rows are left out so they are tried again.
+        """
+
+        columns = ["matched_address", "matched_address_score", "SAM_ID", "location_x", "location_y", "flag", "locator_name"]
+        geocoded_flags = ["Able to geocode to a SAM address.", "Able to geocode to a non-SAM address."]
+
+        previous_results = dict()
+        for address, values in zip(previous[address_field], zip(*[previous[column] for column in columns])):
+            if address is None or pd.isnull(address) or values[5] not in geocoded_flags:
+                continue
+            # missing values become None so they can be set in any of the result arrays
+            previous_results[self._address_hash(address)] = tuple(None if pd.isnull(value) else value for value in values)
+        return previous_results
+
     @classmethod
     # input the given address to the ESRI ArcGIS geocoder, default output coordinate system is 4326
-    def _find_address_candidates(self, SingleLine, Street="", coord_system="4326", outputFields="*", outputType="pjson"):
+    def _find_address_candidates(self, SingleLine, Street="", coord_system="4326", outputFields=LEAN_OUTPUT_FIELDS, outputType="json"):
         """Returns a JSON object of address candidates.
         
         Args:
             SingleLine (str): Specifies the location to be geocoded. The input address components are formatted as a single string.
             Street (str, optional): The street address location to be geocoded.
             coord_system (str, optional): The well-known ID (WKID) of the spatial reference or a spatial reference JSON object for the returned address candidates.
-            outputFields (str, optional): The list of fields to be included in the returned result set. * returns all fields.
-            outputType (str, optional): The response format. The default response format is html.
+            outputFields (str, optional): The list of fields to be included in the returned result set. * returns all fields. Defaults to the fields the candidate is picked by.
+            outputType (str, optional): The response format. Defaults to compact json.
         
         Returns:
             JSON: Object containing candidate addresses.
@@ -88,15 +224,19 @@ class CobArcGISGeocoder(object):
                        "outFields": outputFields,
                        "f": outputType }
         parameters = urllib.parse.urlencode(parameters)
-        candidates_url = "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer/findAddressCandidates?{}".format(parameters) 
+        candidates_url = "{}/findAddressCandidates?{}".format(GEOCODER_URL, parameters) 
 
-        with urllib.request.urlopen(candidates_url) as url:
-            data = url.read().decode("utf-8")
-            candidates = json.loads(data)
+        # ask for a gzipped response, the server sends it uncompressed if it can't
+        request = urllib.request.Request(candidates_url, headers={"Accept-Encoding": "gzip"})
+        with urllib.request.urlopen(request) as url:
+            data = url.read()
+            if url.headers.get("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+        candidates = json.loads(data)
         
         # return the possible candidates as json
         return candidates
-    
+
     @classmethod
     def _pick_address_candidate(self, candidates, locators):
         """Returns the best address from a JSON object of candidates.
@@ -110,6 +250,10 @@ class CobArcGISGeocoder(object):
             none: If there were no candidates returned return None.
         """
 
+        if "error" in candidates:
+            print("Error ocurred while geocoding an address. Error: {}\nContinuing...".format(candidates["error"].get("details")))
+            return None
+
         if len(candidates["candidates"]) > 0:
 
             # if there is at least 1 candidate, put the results into a dataframe
@@ -139,9 +283,28 @@ class CobArcGISGeocoder(object):
             # if there were no candidates returned, return None so the row in the dataframe can be properly flagged
             return None
     
+    @staticmethod
+    def _failure_result(candidates):
+        """Returns how a lookup without a usable candidate failed, to record it in the negative cache.
+
+        Returns:
+            str: "empty" if ArcGIS returned no candidates, "error" if it rejected the address with a 400 error.
+            none: For any other error, such as a 5xx from an overloaded server, which may pass and isn't cached.
+        """
+
+        if "error" not in candidates:
+            return "empty"
+        if candidates["error"].get("code") == 400:
+            return "error"
+        return None
+
     @classmethod
     def _archive_non_sam_address(self, address, returned_result):
-        """Uploads to a postgres table to keep track of addresses that need to be assigned a SAM ID."""
+        """Uploads to a postgres table to keep track of addresses that need to be assigned a SAM ID.
+
+        Returns:
+            bool: True if the address was archived, False if the environment variables are missing or the insert failed.
+        """
 
         env_var_dict = dict()
         env_var_dict['upload_hostname'] = os.environ.get("POSTGRES_IP")
@@ -154,7 +317,7 @@ class CobArcGISGeocoder(object):
         for _, v in env_var_dict.items():
             if v == None:
                 print("Environment variables not found. Continuing...")
-                return
+                return False
 
         config_params = dict()
         config_params['upload_table_name'] = "internal_data.failed_geocoded_addresses"
@@ -182,5 +345,59 @@ class CobArcGISGeocoder(object):
                 print("Incorrect status message from insert operation. Exiting. An error occured.")
                 sys.exit(1)
 
+            return True
+
         except Exception as e:
-            print("ERROR: Issue inserting data into the database. Exiting. Error: {}".format(e))
\ No newline at end of file
+            print("ERROR: Issue inserting data into the database. Exiting. Error: {}".format(e))
+            return False
+
+
+class _NegativeCache(object):
+    """On-disk sqlite cache of addresses that returned no candidates or a 400 error from ArcGIS.
+
+    Args:
+        cache_path (str): Path of the sqlite file. It is created if it doesn't exist.
+        ttl_days (int, optional): Number of days a failed address is skipped before it is geocoded again.
+    """
+
+    def __init__(self, cache_path, ttl_days=7):
+        self.ttl = timedelta(days=ttl_days)
+        self.conn = sqlite3.connect(cache_path, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS failed_addresses (address_submitted TEXT PRIMARY KEY, returned_result TEXT, time_stamp TEXT, archived INTEGER DEFAULT 0)")
+        # caches written before archived was tracked are treated as never archived
+        if "archived" not in [column[1] for column in self.conn.execute("PRAGMA table_info(failed_addresses)")]:
+            self.conn.execute("ALTER TABLE failed_addresses ADD COLUMN archived INTEGER DEFAULT 0")
+        self.conn.commit()
+
+    def get(self, address):
+        """Returns "error" or "empty" if the address failed to geocode within the TTL, otherwise None."""
+
+        oldest = (datetime.now() - self.ttl).isoformat()
+        row = self.conn.execute("SELECT returned_result FROM failed_addresses WHERE address_submitted = ? AND time_stamp >= ?", (address, oldest)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, address, returned_result):
+        """Records that an address failed to geocode.
+
+        Args:
+            address (str): The address that was geocoded.
+            returned_result (str): "error" if ArcGIS rejected the address with a 400 error, "empty" if it returned no candidates.
+
+        Returns:
+            bool: True if the address needs to be archived: it hadn't failed before, failed differently last time or wasn't archived.
+        """
+
+        row = self.conn.execute("SELECT returned_result, archived FROM failed_addresses WHERE address_submitted = ?", (address,)).fetchone()
+        # an archive is only still valid while the address keeps failing the same way
+        archived = 1 if row is not None and row[0] == returned_result and row[1] else 0
+        self.conn.execute("INSERT OR REPLACE INTO failed_addresses (address_submitted, returned_result, time_stamp, archived) VALUES (?, ?, ?, ?)", (address, returned_result, datetime.now().isoformat(), archived))
+        self.conn.commit()
+        return not archived
+
+    def mark_archived(self, address):
+        """Records that a failed address was archived, so it isn't archived again until it fails differently."""
+
+        self.conn.execute("UPDATE failed_addresses SET archived = 1 WHERE address_submitted = ?", (address,))
+        self.conn.commit()
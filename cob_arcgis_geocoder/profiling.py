@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import contextlib
+import threading
+from collections import Counter, OrderedDict
+
+# file path fragments that put a sampled stack into a category, checked from the innermost frame outwards
+CATEGORY_PATHS = OrderedDict([("waiting", [os.sep + "threading.py", os.sep + "queue.py"]),
+                              ("network", [os.sep + "http" + os.sep, os.sep + "urllib" + os.sep, os.sep + "socket.py", os.sep + "ssl.py"]),
+                              ("json", [os.sep + "json" + os.sep]),
+                              ("db", [os.sep + "psycopg2" + os.sep, os.sep + "sqlite3" + os.sep]),
+                              ("pandas", [os.sep + "pandas" + os.sep, os.sep + "numpy" + os.sep, os.sep + "pyarrow" + os.sep])])
+
+# functions, by file name and function name, whose own time is spent in a C extension, so no frame of the extension
+# shows up in the sample. Matched on the code object only, reading the locals of another thread's frame isn't safe.
+CATEGORY_FUNCTIONS = {("geocode.py", "_archive_non_sam_address"): "db",
+                      # _ResultStore and _NegativeCache methods
+                      ("geocode.py", "conn"): "db",
+                      ("geocode.py", "get"): "db",
+                      ("geocode.py", "put"): "db",
+                      ("geocode.py", "get_failure"): "db",
+                      ("geocode.py", "put_failure"): "db",
+                      ("geocode.py", "mark_archived"): "db",
+                      ("geocode.py", "mark_failure_archived"): "db"}
+
+
+class Profiler(object):
+    """Profiles a geocoding run with cProfile and a sampling wall-clock profiler.
+
+    Used as a context manager around the run. When it exits three files are written using output_path as a prefix:
+
+        <output_path>.prof: cProfile stats that can be loaded with pstats or snakeviz.
+        <output_path>.collapsed.txt: sampled stacks in the collapsed format read by flamegraph.pl and speedscope.
+        <output_path>.profile.txt: wall-clock breakdown across network, JSON, pandas and DB time and the top-N hot functions.
+
+    Args:
+        output_path (str): Path prefix of the profile files.
+        interval (float, optional): Seconds between stack samples. Defaults to 5 milliseconds.
+        top (int, optional): Number of functions listed in the summary. Defaults to 25.
+    """
+
+    def __init__(self, output_path, interval=0.005, top=25):
+        self.output_path = output_path
+        self.interval = interval
+        self.top = top
+        self.profile = None
+        # profiles of other threads started through thread_profile
+        self.profiles = []
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.sampler = None
+        self.started = None
+        self.wall_seconds = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(target=self._sample, name="profiler-sampler")
+        self.sampler.daemon = True
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        self.stop.set()
+        self.sampler.join()
+        self.wall_seconds = time.perf_counter() - self.started
+        self._write()
+        return False
+
+    @contextlib.contextmanager
+    def thread_profile(self):
+        """Profiles the calling thread with its own cProfile profile while the context is open.
+
+        From Python 3.12 cProfile is built on sys.monitoring, which is process wide: the profile started in
+        __enter__ already sees every thread and a second profile can't be enabled, so nothing is started.
+        """
+
+        if sys.version_info >= (3, 12):
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        # only profiles that were enabled are added to the stats
+        with self.lock:
+            self.profiles.append(profile)
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def _sample(self):
+        sampler_id = threading.get_ident()
+        thread_names = dict()
+        while not self.stop.wait(self.interval):
+            for thread in threading.enumerate():
+                thread_names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                category = None
+                while frame is not None:
+                    if category is None:
+                        category = self._categorize(frame)
+                    stack.append("{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+                self.categories[category or "other"] += 1
+
+    @staticmethod
+    def _categorize(frame):
+        file_name = frame.f_code.co_filename
+        for category, paths in CATEGORY_PATHS.items():
+            if any(path in file_name for path in paths):
+                return category
+        return CATEGORY_FUNCTIONS.get((os.path.basename(file_name), frame.f_code.co_name))
+
+    def _write(self):
+        stats = pstats.Stats(self.profile)
+        for profile in self.profiles:
+            stats.add(profile)
+        stats.dump_stats("{}.prof".format(self.output_path))
+
+        with open("{}.collapsed.txt".format(self.output_path), "w", encoding="UTF-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+
+        with open("{}.profile.txt".format(self.output_path), "w", encoding="UTF-8") as f:
+            samples = sum(self.categories.values())
+            f.write("Wall time: {:.1f}s, {} samples every {:.0f}ms across all threads\n\n".format(self.wall_seconds, samples, self.interval * 1000))
+            f.write("{:<10}{:>10}{:>10}\n".format("category", "seconds", "share"))
+            for category in list(CATEGORY_PATHS.keys()) + ["other"]:
+                count = self.categories.get(category, 0)
+                f.write("{:<10}{:>10.1f}{:>10.1%}\n".format(category, count * self.interval, count / float(samples) if samples else 0.0))
+
+            f.write("\nTop {} functions by own time\n".format(self.top))
+            stats.stream = f
+            stats.sort_stats("tottime").print_stats(self.top)
+            f.write("\nTop {} functions by cumulative time\n".format(self.top))
+            stats.sort_stats("cumulative").print_stats(self.top)
+
+        print("Wrote profile to {0}.prof, {0}.collapsed.txt and {0}.profile.txt".format(self.output_path))
@@ -1,10 +1,16 @@
 import os
 import sys
+import numpy as np
 import pandas as pd
 from json import loads
+from collections import OrderedDict
 from urllib.parse import urlencode
 from urllib.request import urlopen
 from pandas.io.json import json_normalize
+from cob_arcgis_geocoder.profiling import Profiler
+
+# base url of the geocode service, set ARCGIS_GEOCODER_URL to use another server
+GEOCODER_URL = os.environ.get("ARCGIS_GEOCODER_URL", "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer")
 
 
 class CobArcGISReverseGeocoder(object):
@@ -19,49 +25,93 @@ class CobArcGISReverseGeocoder(object):
 
 
 
-    def reverse_geocode_df(self):
+    def reverse_geocode_df(self, inplace=False, columns_only=False, profile=None):
         """
         Primary Class Method
 
         Returns a Dataframe copied to an existing dataframe, given that class is initialized with proper parameters
 
-        """
-        df = pd.concat([self.df,pd.DataFrame(columns=['Street', 'City', 'Zip', 'Address', 'matched_x_coord', 'matched_y_coord', 'output_coord_system', 'locator_name'])])
+        With inplace or columns_only only the result columns are allocated, with float64 matched coordinates, a nullable
+        integer output_coord_system and a categorical locator_name. The default output keeps object dtype result columns.
 
-        for index, row in df.iterrows():
+        Params:
+            inplace (Boolean, optional): add the result columns to the input dataframe instead of returning a copy of it. Returns None.
+            columns_only (Boolean, optional): return only the result columns, indexed like the input dataframe.
+            profile (str, optional): path prefix to write cProfile stats, collapsed stacks and a hot function summary to.
+
+        """
+        if profile is not None:
+            with Profiler(profile):
+                return self.reverse_geocode_df(inplace, columns_only)
+
+        row_count = len(self.df.index)
+
+        #arrays for the results, filled in by position
+        street = np.full(row_count, None, dtype=object)
+        city = np.full(row_count, None, dtype=object)
+        zip_code = np.full(row_count, None, dtype=object)
+        address = np.full(row_count, None, dtype=object)
+        matched_x_coord = np.full(row_count, np.nan)
+        matched_y_coord = np.full(row_count, np.nan)
+        output_coord_system = np.full(row_count, np.nan)
+        locator_name = np.full(row_count, None, dtype=object)
+
+        rows = zip(self.df[self.x], self.df[self.y], self.df[self.input_coord_system],
+                   self.df[self.output_coord_system], self.df[self.return_intersection])
+
+        for position, (x, y, input_coord_system, output_coord_system_value, return_intersection) in enumerate(rows):
             """
             If either of the coordinates do not exist, set a message to the Address field that is unable to find an address.
-            If both coordinates are present, reverse geocode those coordinates and set them to the dataframe object. 
+            If both coordinates are present, reverse geocode those coordinates and set them to the result arrays. 
             """
-            if row[self.x] is None or row[self.y] is None:
-                df.at[index, 'Address'] = "Insufficient coordinates given.  Unable to find an address."
+            if x is None or y is None:
+                address[position] = "Insufficient coordinates given.  Unable to find an address."
             else:
                 #fetch the results from the API
-                apicall_results = self._reverse_geocode(row[self.x], row[self.y], row[self.input_coord_system],
-                 row[self.output_coord_system], row[self.return_intersection])
+                apicall_results = self._reverse_geocode(x, y, input_coord_system,
+                 output_coord_system_value, return_intersection)
                 #clean those results up, clean columns up
                 address_df = self._parse_address_results(apicall_results)
 
                 if address_df is not None:
-                    df.at[index, "Street"] = address_df[["Street"]][0]
-                    df.at[index, "City"] = address_df[["City"]][0]
-                    df.at[index, "Address"] = address_df[["Match_addr"]][0]
-                    df.at[index, "Zip"] = address_df[["ZIP"]][0]
-                    df.at[index, "matched_x_coord"] = address_df[["x"]][0]
-                    df.at[index, "matched_y_coord"] = address_df[["y"]][0]
-                    df.at[index, "output_coord_system"] = address_df[["output_coord_system_field"]][0]
-                    df.at[index, "locator_name"] = address_df[["Loc_name"]][0]
+                    street[position] = address_df["Street"][0]
+                    city[position] = address_df["City"][0]
+                    address[position] = address_df["Match_addr"][0]
+                    zip_code[position] = address_df["ZIP"][0]
+                    matched_x_coord[position] = address_df["x"][0]
+                    matched_y_coord[position] = address_df["y"][0]
+                    output_coord_system[position] = address_df["output_coord_system"][0]
+                    locator_name[position] = address_df["Loc_name"][0]
                 else:
                     #If the results are an empty set, set Address to None
                     #Also set x and y to 0.0
-                    df.at[index, "Address"] = None
-                    df.at[index, 'matched_x_coord'] = 0.0
-                    df.at[index, 'matched_y_coord'] = 0.0
-            return df
-
-
+                    address[position] = None
+                    matched_x_coord[position] = 0.0
+                    matched_y_coord[position] = 0.0
+
+        results = pd.DataFrame(OrderedDict([('Street', street), ('City', city), ('Zip', zip_code), ('Address', address),
+                                            ('matched_x_coord', matched_x_coord), ('matched_y_coord', matched_y_coord),
+                                            ('output_coord_system', pd.array(output_coord_system, dtype="Int64")),
+                                            ('locator_name', pd.Categorical(locator_name))]),
+                               index=self.df.index)
+
+        if columns_only:
+            return results
+
+        if inplace:
+            #only the result columns are allocated, the existing columns are left where they are
+            for column in results.columns:
+                self.df[column] = results[column]
+            return None
 
+        #the default output is a copy of the input with object result columns, replacing input columns of the same name
+        #such as the output_coord_system column the rows are reverse geocoded with
+        df = self.df.copy()
+        for column in results.columns:
+            df[column] = results[column].astype(object)
+        df['output_coord_system'] = pd.Series(np.array([np.nan if np.isnan(value) else int(value) for value in output_coord_system], dtype=object), index=df.index)
 
+        return df
 
 
     @classmethod
@@ -99,7 +149,7 @@ class CobArcGISReverseGeocoder(object):
         }
         url_params = urlencode(json_params)
 
-        reverse_geocode_url = "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer/reverseGeocode?{}".format(url_params)
+        reverse_geocode_url = "{}/reverseGeocode?{}".format(GEOCODER_URL, url_params)
         #make request to Reverse geocode service
         with urlopen(reverse_geocode_url) as url:
             data = url.read().decode("utf-8")
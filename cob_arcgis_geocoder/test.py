@@ -1,8 +1,39 @@
+import os
+import shutil
+import sys
+import tempfile
+import multiprocessing
+import threading
+import time
 import unittest
+import importlib.util
 import pandas as pd
 from cob_arcgis_geocoder.geocode import CobArcGISGeocoder
 from cob_arcgis_geocoder.reverse_geocode import CobArcGISReverseGeocoder
 
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the geocode script isn't part of the package, so it is loaded from its file
+_spec = importlib.util.spec_from_file_location("geocode_script", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts", "geocode.py"))
+geocode_script = importlib.util.module_from_spec(_spec)
+# registered so worker processes can unpickle the functions handed to them
+sys.modules["geocode_script"] = geocode_script
+_spec.loader.exec_module(geocode_script)
+
+def _sam_candidates(SingleLine):
+    """Returns one SAM candidate whose SAM ID is the street number of the address plus 2**60, without calling ArcGIS."""
+
+    number = int(SingleLine.split()[0])
+    # earlier addresses answer slower so chunks finish out of order
+    time.sleep(0.001 * (30 - number % 30))
+    return {"candidates": [{"address": SingleLine.upper(), "score": 100.0, "location": {"x": -71.0, "y": 42.0},
+                            "attributes": {"Ref_ID": 2**60 + number, "Loc_name": "SAM_Alternate"}}]}
+
 # test able to initiate class
 class TestInitiatingGeocoderClass(unittest.TestCase):
     def setUp(self):
@@ -115,6 +146,359 @@ class TestHandlesNotFindingAddressAsExpected(unittest.TestCase):
     def test_reverse_geocode_to_point_address(self):
         self.assertEqual(self.geocode_df["flag"][0], "Unable to geocode to any address.")
 
+class TestColumnsOnlyReturnsResultBlock(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({"id": [1, 2], "address": [None, None]}, index=[10, 20])
+        self.address = "address"
+        self.geocoder = CobArcGISGeocoder(self.df, self.address)
+        self.results = self.geocoder.geocode_df(columns_only=True)
+
+    def test_only_result_columns_returned(self):
+        self.assertEqual(list(self.results.columns), ["matched_address", "matched_address_score", "SAM_ID", "location_x", "location_y", "flag", "locator_name"])
+
+    def test_indexed_like_input(self):
+        self.assertEqual(list(self.results.index), [10, 20])
+
+    def test_coordinates_are_floats(self):
+        self.assertEqual(self.results["location_x"].dtype, "float64")
+
+    def test_handle_null_address(self):
+        self.assertEqual(self.results.loc[20, "flag"], "No address provided. Unable to geocode.")
+
+class TestInplaceAddsResultColumns(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({"id": [1], "address": [None]})
+        self.address = "address"
+        self.geocoder = CobArcGISGeocoder(self.df, self.address)
+        self.returned = self.geocoder.geocode_df(inplace=True)
+
+    def test_returns_none(self):
+        self.assertIsNone(self.returned)
+
+    def test_input_has_result_columns(self):
+        self.assertEqual(self.df["flag"][0], "No address provided. Unable to geocode.")
+
+class TestDefaultOutputReplacesResultColumns(unittest.TestCase):
+    def setUp(self):
+        self.find_address_candidates = CobArcGISGeocoder._find_address_candidates
+        self.pick_address_candidate = CobArcGISGeocoder._pick_address_candidate
+        # a SAM candidate whose Ref_ID isn't a number
+        candidate = pd.Series({"address": "1 CITY HALL PLZ, BOSTON, 02108", "score": 100.0, "attributes.Ref_ID": "",
+                               "location.x": -71.0579, "location.y": 42.3604, "attributes.Loc_name": "SAM_Alternate",
+                               "flag": "Able to geocode to a SAM address."})
+        CobArcGISGeocoder._find_address_candidates = classmethod(lambda cls, SingleLine: {"candidates": []})
+        CobArcGISGeocoder._pick_address_candidate = classmethod(lambda cls, candidates, locators: candidate)
+        self.df = pd.DataFrame({"id": [1], "address": ["1 City Hall Plz, Boston, 02108"], "flag": ["reviewed"]})
+        self.geocoder = CobArcGISGeocoder(self.df, "address")
+        self.geocode_df = self.geocoder.geocode_df()
+        self.results = self.geocoder.geocode_df(columns_only=True)
+
+    def tearDown(self):
+        CobArcGISGeocoder._find_address_candidates = self.find_address_candidates
+        CobArcGISGeocoder._pick_address_candidate = self.pick_address_candidate
+
+    def test_result_column_not_duplicated(self):
+        self.assertEqual(list(self.geocode_df.columns).count("flag"), 1)
+
+    def test_result_column_replaced(self):
+        self.assertEqual(self.geocode_df["flag"][0], "Able to geocode to a SAM address.")
+
+    def test_result_columns_are_objects(self):
+        self.assertEqual(self.geocode_df["location_x"].dtype, object)
+
+    def test_keeps_non_numeric_sam_id(self):
+        self.assertEqual((self.geocode_df["SAM_ID"][0], self.results["SAM_ID"][0]), ("", ""))
+
+    def test_input_left_unchanged(self):
+        self.assertEqual(self.df["flag"][0], "reviewed")
+
+class TestCarriesForwardPreviousResults(unittest.TestCase):
+    def setUp(self):
+        self.previous = pd.DataFrame({"id": [1], "address": ["1 CITY HALL PLZ BOSTON 02108"], "matched_address": ["1 CITY HALL PLZ, BOSTON, 02108"],
+                                      "matched_address_score": [100.0], "SAM_ID": [32856], "location_x": [-71.0579], "location_y": [42.3604],
+                                      "flag": ["Able to geocode to a SAM address."], "locator_name": ["SAM_Alternate"]})
+        self.df = pd.DataFrame({"id": [1, 2], "address": ["1 City Hall Plz, Boston, 02108", None]})
+        self.address = "address"
+        self.geocoder = CobArcGISGeocoder(self.df, self.address)
+        self.geocode_df = self.geocoder.geocode_df(previous=self.previous)
+
+    def test_reuses_previous_sam_id(self):
+        self.assertEqual(self.geocode_df["SAM_ID"][0], 32856)
+
+    def test_reports_reused_and_requested_rows(self):
+        self.assertEqual((self.geocoder.rows_reused, self.geocoder.rows_requested), (1, 0))
+
+class TestNegativeCacheSkipsKnownFailures(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.cache_dir, "negative_cache.sqlite")
+        self.df = pd.DataFrame({"id": [1], "address": ["This isn't an address."]})
+        self.address = "address"
+        self.geocoder = CobArcGISGeocoder(self.df, self.address, negative_cache=self.cache_path)
+        self.recorded_first = self.geocoder.negative_cache.put("This isn't an address.", "empty")
+        self.recorded_unarchived = self.geocoder.negative_cache.put("This isn't an address.", "empty")
+        self.geocoder.negative_cache.mark_archived("This isn't an address.")
+        self.recorded_archived = self.geocoder.negative_cache.put("This isn't an address.", "empty")
+        self.recorded_changed = self.geocoder.negative_cache.put("This isn't an address.", "error")
+        self.geocode_df = self.geocoder.geocode_df()
+
+    def tearDown(self):
+        self.geocoder.negative_cache.conn.close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_flags_known_failure(self):
+        self.assertEqual(self.geocode_df["flag"][0], "Unable to geocode to any address.")
+
+    def test_reports_failure_until_archived(self):
+        self.assertEqual((self.recorded_first, self.recorded_unarchived, self.recorded_archived), (True, True, False))
+
+    def test_reports_changed_failure(self):
+        self.assertTrue(self.recorded_changed)
+
+class TestNegativeCacheSkipsTransientErrors(unittest.TestCase):
+    def setUp(self):
+        self.find_address_candidates = CobArcGISGeocoder._find_address_candidates
+        errors = {"Overloaded address": {"error": {"code": 500, "message": "Unable to complete operation.", "details": []}},
+                  "Rejected address": {"error": {"code": 400, "message": "Unable to complete operation.", "details": []}}}
+        CobArcGISGeocoder._find_address_candidates = classmethod(lambda cls, SingleLine: errors[SingleLine])
+        self.cache_dir = tempfile.mkdtemp()
+        self.df = pd.DataFrame({"id": [1, 2], "address": ["Overloaded address", "Rejected address"]})
+        self.geocoder = CobArcGISGeocoder(self.df, "address", negative_cache=os.path.join(self.cache_dir, "negative_cache.sqlite"))
+        self.geocode_df = self.geocoder.geocode_df()
+
+    def tearDown(self):
+        CobArcGISGeocoder._find_address_candidates = self.find_address_candidates
+        self.geocoder.negative_cache.conn.close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_flags_both_failures(self):
+        self.assertEqual(list(self.geocode_df["flag"]), ["Unable to geocode to any address."] * 2)
+
+    def test_server_error_not_cached(self):
+        self.assertIsNone(self.geocoder.negative_cache.get("Overloaded address"))
+
+    def test_rejected_address_cached(self):
+        self.assertEqual(self.geocoder.negative_cache.get("Rejected address"), "error")
+
+class TestProfileWritesProfileFiles(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.profile = os.path.join(self.profile_dir, "geocode")
+        self.df = pd.DataFrame({"id": [1], "address": [None]})
+        self.address = "address"
+        self.geocoder = CobArcGISGeocoder(self.df, self.address)
+        self.geocode_df = self.geocoder.geocode_df(profile=self.profile)
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def test_returns_geocoded_df(self):
+        self.assertEqual(self.geocode_df["flag"][0], "No address provided. Unable to geocode.")
+
+    def test_writes_profile_files(self):
+        for extension in [".prof", ".collapsed.txt", ".profile.txt"]:
+            self.assertTrue(os.path.isfile(self.profile + extension))
+
+# Geocode Script Pipeline Tests
+class TestPipelineKeepsRowOrder(unittest.TestCase):
+    def setUp(self):
+        self.find_address_candidates = geocode_script._find_address_candidates
+        geocode_script._find_address_candidates = _sam_candidates
+        self.output_dir = tempfile.mkdtemp()
+        input_path = os.path.join(self.output_dir, "addresses.csv")
+        pd.DataFrame({"id": list(range(30)), "address": ["{} Main St".format(i) for i in range(30)]}).to_csv(input_path, index=False)
+        writer = geocode_script._OutputWriter(os.path.join(self.output_dir, "geocoded.csv"), "csv")
+        # a small shard size spreads the rows over many chunks geocoded by several threads
+        self.counts = geocode_script.geocode_file(geocode_script._read_chunks(input_path, "csv", 3), "address", writer, threads=4)
+        writer.close()
+        self.output = pd.read_csv(os.path.join(self.output_dir, "geocoded.csv"))
+
+    def tearDown(self):
+        geocode_script._find_address_candidates = self.find_address_candidates
+        shutil.rmtree(self.output_dir)
+
+    def test_rows_written_in_input_order(self):
+        self.assertEqual(list(self.output["id"]), list(range(30)))
+
+    def test_results_match_their_rows(self):
+        self.assertEqual(list(self.output["SAM_ID"]), [2**60 + i for i in range(30)])
+
+    def test_reports_requested_rows(self):
+        self.assertEqual(self.counts, (30, 0, 30))
+
+# stubs only reach the worker processes when they are forked from this one
+@unittest.skipIf(multiprocessing.get_start_method() != "fork", "worker processes aren't forked")
+class TestShardedRunKeepsRowOrder(unittest.TestCase):
+    def setUp(self):
+        self.find_address_candidates = geocode_script._find_address_candidates
+        geocode_script._find_address_candidates = _sam_candidates
+        self.output_dir = tempfile.mkdtemp()
+        chunks = (pd.DataFrame({"id": list(range(start, start + 3)), "address": ["{} Main St".format(i) for i in range(start, start + 3)]}) for start in range(0, 30, 3))
+        writer = geocode_script._OutputWriter(os.path.join(self.output_dir, "geocoded.csv"), "csv")
+        shard_dir = os.path.join(self.output_dir, "shards")
+        os.mkdir(shard_dir)
+        self.counts = geocode_script.geocode_file_sharded(chunks, "address", writer, 2, shard_dir, max_shards=3)
+        writer.close()
+        self.shards_left = os.listdir(shard_dir)
+        self.output = pd.read_csv(os.path.join(self.output_dir, "geocoded.csv"))
+
+    def tearDown(self):
+        geocode_script._find_address_candidates = self.find_address_candidates
+        shutil.rmtree(self.output_dir)
+
+    def test_rows_written_in_input_order(self):
+        self.assertEqual(list(self.output["id"]), list(range(30)))
+
+    def test_results_match_their_rows(self):
+        self.assertEqual(list(self.output["SAM_ID"]), [2**60 + i for i in range(30)])
+
+    def test_reports_requested_rows(self):
+        self.assertEqual(self.counts, (30, 0, 30))
+
+    def test_removes_shards(self):
+        self.assertEqual(self.shards_left, [])
+
+class TestResultStoreReusesResults(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.result_store = geocode_script._ResultStore(os.path.join(self.store_dir, "results.sqlite"))
+        self.candidates = _sam_candidates("1 Main St")
+        self.result_store.put("1 Main St", self.candidates)
+        self.result_store.put_failure("This isn't an address.", "empty")
+        self.counts = {"requested": 0}
+        self.find_address_candidates = geocode_script._find_address_candidates
+        geocode_script._find_address_candidates = _sam_candidates
+        self.stored = geocode_script._get_address_candidates("1 Main St", self.result_store, self.counts)
+
+    def tearDown(self):
+        geocode_script._find_address_candidates = self.find_address_candidates
+        self.result_store.conn.close()
+        shutil.rmtree(self.store_dir)
+
+    def test_returns_stored_candidates(self):
+        self.assertEqual(self.stored, self.candidates)
+
+    def test_stored_candidates_are_not_requested(self):
+        self.assertEqual(self.counts["requested"], 0)
+
+    def test_returns_known_failure(self):
+        self.assertEqual(self.result_store.get_failure("This isn't an address."), "empty")
+
+    def test_unknown_address_has_no_failure(self):
+        self.assertIsNone(self.result_store.get_failure("1 Main St"))
+
+class TestLoadsPreviousResults(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        path = os.path.join(self.output_dir, "previous.csv")
+        # the blank SAM_ID of the non-SAM row makes read_csv parse the column as floats
+        pd.DataFrame({"address": ["1 City Hall Plz, Boston, 02108", "890 Commonwealth Avenue", "This isn't an address."],
+                      "matched_address": ["1 CITY HALL PLZ, BOSTON, 02108", "890 COMMONWEALTH AVE, BOSTON, MA, 02215", None],
+                      "matched_address_score": [100.0, 100.0, None], "SAM_ID": [32856, None, None],
+                      "location_x": [-71.0579, -71.1160, 0.0], "location_y": [42.3604, 42.3513, 0.0],
+                      "flag": ["Able to geocode to a SAM address.", "Able to geocode to a non-SAM address.", "Unable to geocode to any address."],
+                      "locator_name": ["SAM_Alternate", "Point_Address", None]}).to_csv(path, index=False)
+        self.previous_results = geocode_script._load_previous_results(path, "address")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_keyed_by_normalized_address(self):
+        self.assertIn(geocode_script._address_hash("1 CITY HALL PLZ BOSTON 02108"), self.previous_results)
+
+    def test_sam_id_is_int(self):
+        sam_id = self.previous_results[geocode_script._address_hash("1 City Hall Plz, Boston, 02108")][2]
+        self.assertEqual((type(sam_id), sam_id), (int, 32856))
+
+    def test_missing_sam_id_is_none(self):
+        self.assertIsNone(self.previous_results[geocode_script._address_hash("890 Commonwealth Avenue")][2])
+
+    def test_failed_rows_left_out(self):
+        self.assertEqual(len(self.previous_results), 2)
+
+class TestPipelineRaisesGeocodeErrors(unittest.TestCase):
+    def setUp(self):
+        def find_address_candidates(SingleLine):
+            if SingleLine.startswith("13 "):
+                raise ValueError("Lookup failed")
+            return _sam_candidates(SingleLine)
+
+        self.find_address_candidates = geocode_script._find_address_candidates
+        geocode_script._find_address_candidates = find_address_candidates
+        self.output_dir = tempfile.mkdtemp()
+        chunks = (pd.DataFrame({"address": ["{} Main St".format(i) for i in range(start, start + 3)]}) for start in range(0, 30, 3))
+        writer = geocode_script._OutputWriter(os.path.join(self.output_dir, "geocoded.csv"), "csv")
+        self.errors = []
+
+        def run():
+            try:
+                geocode_script.geocode_file(chunks, "address", writer, threads=4, queue_size=1)
+            except Exception as e:
+                self.errors.append(e)
+
+        # run in another thread so a hung pipeline fails the test instead of blocking it
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.thread.join(60)
+
+    def tearDown(self):
+        geocode_script._find_address_candidates = self.find_address_candidates
+        shutil.rmtree(self.output_dir)
+
+    def test_does_not_hang(self):
+        self.assertFalse(self.thread.is_alive())
+
+    def test_raises_geocode_error(self):
+        self.assertIsInstance(self.errors[0], ValueError)
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class TestTypedOutputRoundTrips(unittest.TestCase):
+    def setUp(self):
+        self.find_address_candidates = geocode_script._find_address_candidates
+        geocode_script._find_address_candidates = _sam_candidates
+        self.output_dir = tempfile.mkdtemp()
+        self.tables = dict()
+        self.chunks = dict()
+        input_fields = [pyarrow.field("id", pyarrow.int64()), pyarrow.field("address", pyarrow.string())]
+        for file_format in ["parquet", "arrow"]:
+            path = os.path.join(self.output_dir, "geocoded.{}".format(file_format))
+            chunks = [pd.DataFrame({"id": [2**60 + 1, 2], "address": ["1 Main St", "2 Main St"]}),
+                      pd.DataFrame({"id": [3], "address": [None]})]
+            # each chunk becomes its own row group or record batch, so the dictionaries grow between them
+            writer = geocode_script._OutputWriter(path, file_format, input_fields)
+            for chunk in chunks:
+                writer.write(geocode_script.geocode_df(chunk, "address"))
+            writer.close()
+            if file_format == "parquet":
+                self.tables[file_format] = pyarrow.parquet.read_table(path)
+            else:
+                with pyarrow.memory_map(path) as source:
+                    self.tables[file_format] = pyarrow.ipc.open_file(source).read_all()
+            self.chunks[file_format] = pd.concat(list(geocode_script._read_chunks(path, file_format, 10)), ignore_index=True)
+
+    def tearDown(self):
+        geocode_script._find_address_candidates = self.find_address_candidates
+        shutil.rmtree(self.output_dir)
+
+    def test_typed_schema(self):
+        for table in self.tables.values():
+            self.assertEqual(table.schema.field("id").type, pyarrow.int64())
+            self.assertEqual(table.schema.field("SAM_ID").type, pyarrow.int64())
+            self.assertEqual(table.schema.field("location_x").type, pyarrow.float64())
+            self.assertEqual(table.schema.field("matched_address_score").type, pyarrow.float64())
+            self.assertTrue(pyarrow.types.is_dictionary(table.schema.field("flag").type))
+            self.assertTrue(pyarrow.types.is_dictionary(table.schema.field("locator_name").type))
+
+    def test_keeps_int64_precision(self):
+        for df in self.chunks.values():
+            self.assertEqual(list(df["id"]), [2**60 + 1, 2, 3])
+            self.assertEqual(list(df["SAM_ID"]), [2**60 + 1, 2**60 + 2, None])
+
+    def test_reads_back_flags(self):
+        for df in self.chunks.values():
+            self.assertEqual(list(df["flag"].astype(object)), ["Able to geocode to a SAM address.", "Able to geocode to a SAM address.", "No address provided. Unable to geocode."])
+
 #Actual ReverseGeocoder Test Cases
 
 class TestInitiatingReverseGeocoderClass(unittest.TestCase):
@@ -269,3 +653,43 @@ class TestReverseGeocoderwithMAStatePlainCoordsasInputandOutput(unittest.TestCas
     def test_default_output_coord_sys(self):
         print(self.api_results)
         self.assertEqual(self.address_df['latest_coord_system'][0], 2249)
+
+
+class TestReverseGeocodeDfModes(unittest.TestCase):
+    def setUp(self):
+        self.reverse_geocode = CobArcGISReverseGeocoder._reverse_geocode
+        response = {"address": {"Match_addr": "1 City Hall Plz, Boston, 32856, 02108", "Loc_name": "SAM_Alternate",
+                                "Street": "1 City Hall Plz", "City": "Boston", "ZIP": "02108"},
+                    "location": {"x": -71.0579, "y": 42.3604, "spatialReference": {"wkid": 4326, "latestWkid": 4326}}}
+        CobArcGISReverseGeocoder._reverse_geocode = classmethod(lambda cls, x, y, input_coord_system="4326", output_coord_system="4326", return_intersection=False: response)
+        # the output coordinate system of each row is read from a column with the same name as a result column
+        self.df = pd.DataFrame({"id": [1, 2], "x_coord": pd.Series([-71.057128, None], dtype=object), "y_coord": pd.Series([42.360032, None], dtype=object),
+                                "input_coord_system": [4326, 4326], "output_coord_system": [4326, 4326], "return_intersection": [False, False]})
+
+    def tearDown(self):
+        CobArcGISReverseGeocoder._reverse_geocode = self.reverse_geocode
+
+    def reverse_geocoder(self):
+        return CobArcGISReverseGeocoder(self.df, "x_coord", "y_coord", "input_coord_system", "output_coord_system", "return_intersection")
+
+    def test_default_returns_one_column_per_result(self):
+        output = self.reverse_geocoder().reverse_geocode_df()
+        self.assertEqual(list(output.columns).count("output_coord_system"), 1)
+        self.assertEqual(output["output_coord_system"][0], 4326)
+        self.assertEqual(list(output["Address"]), ["1 City Hall Plz, Boston, 32856, 02108", "Insufficient coordinates given.  Unable to find an address."])
+
+    def test_default_leaves_input_unchanged(self):
+        self.reverse_geocoder().reverse_geocode_df()
+        self.assertNotIn("Address", self.df.columns)
+
+    def test_inplace_adds_result_columns(self):
+        returned = self.reverse_geocoder().reverse_geocode_df(inplace=True)
+        self.assertIsNone(returned)
+        self.assertEqual(self.df["Street"][0], "1 City Hall Plz")
+        self.assertEqual(self.df["output_coord_system"].dtype, "Int64")
+
+    def test_columns_only_returns_result_block(self):
+        results = self.reverse_geocoder().reverse_geocode_df(columns_only=True)
+        self.assertEqual(list(results.columns), ["Street", "City", "Zip", "Address", "matched_x_coord", "matched_y_coord", "output_coord_system", "locator_name"])
+        self.assertEqual(results["matched_x_coord"][0], -71.0579)
+        self.assertEqual(results["locator_name"][0], "SAM_Alternate")
@@ -0,0 +1,87 @@
+import argparse
+import resource
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+from cob_arcgis_geocoder.geocode import CobArcGISGeocoder
+
+RESULT_COLUMNS = ["matched_address", "matched_address_score", "SAM_ID", "location_x", "location_y", "flag", "locator_name"]
+
+# what _pick_address_candidate returns for a SAM address, used for every row so no requests are made
+PICKED_CANDIDATE = pd.Series({"address": "1 CITY HALL PLZ, BOSTON, 02108",
+                              "score": 100.0,
+                              "attributes.Ref_ID": 32856,
+                              "location.x": -71.057914,
+                              "location.y": 42.360398,
+                              "attributes.Loc_name": "SAM_Alternate",
+                              "flag": "Able to geocode to a SAM address."})
+
+
+def _peak_rss_mb():
+    """Returns the peak resident set size of this process in MB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+def _build_df(rows, width):
+    """Returns a wide dataframe of addresses to geocode."""
+
+    columns = dict(("value_{}".format(i), np.random.rand(rows)) for i in range(width))
+    columns["address"] = np.full(rows, "1 City Hall Plz, Boston, 02108", dtype=object)
+    return pd.DataFrame(columns)
+
+def _legacy_geocode_df(df, address_field):
+    """Geocodes the way geocode_df did before inplace and columns_only: the whole frame is copied and the result columns are object dtype."""
+
+    df = pd.concat([df, pd.DataFrame(columns=RESULT_COLUMNS)])
+    for index, row in df.iterrows():
+        matched_address_df = CobArcGISGeocoder._pick_address_candidate(CobArcGISGeocoder._find_address_candidates(SingleLine=row[address_field]), [])
+        df.at[index, "matched_address"] = matched_address_df[["address"]][0]
+        df.at[index, "matched_address_score"] = matched_address_df[["score"]][0]
+        df.at[index, "SAM_ID"] = matched_address_df[["attributes.Ref_ID"]][0]
+        df.at[index, "location_x"] = matched_address_df[["location.x"]][0]
+        df.at[index, "location_y"] = matched_address_df[["location.y"]][0]
+        df.at[index, "flag"] = matched_address_df[["flag"]][0]
+        df.at[index, "locator_name"] = matched_address_df[["attributes.Loc_name"]][0]
+    return df
+
+def run_mode(mode, rows, width):
+    """Geocodes a generated dataframe with one mode and prints the memory it used."""
+
+    # answer every lookup with the same candidate instead of calling ArcGIS
+    CobArcGISGeocoder._find_address_candidates = classmethod(lambda cls, SingleLine: {"candidates": []})
+    CobArcGISGeocoder._pick_address_candidate = classmethod(lambda cls, candidates, locators: PICKED_CANDIDATE)
+
+    df = _build_df(rows, width)
+    before = _peak_rss_mb()
+
+    if mode == "legacy":
+        result = _legacy_geocode_df(df, "address")
+    else:
+        geocoder = CobArcGISGeocoder(df, "address")
+        result = geocoder.geocode_df(inplace=mode == "inplace", columns_only=mode == "columns_only")
+
+    after = _peak_rss_mb()
+    print("{:<14}{:>12.1f}{:>12.1f}{:>12.1f}".format(mode, before, after, after - before))
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the peak memory used by the geocode_df modes against the previous copying implementation.")
+    parser.add_argument("--rows", type=int, default=200000, help="Number of rows to geocode. Defaults to 200000.")
+    parser.add_argument("--width", type=int, default=20, help="Number of float columns in the input besides the address. Defaults to 20.")
+    parser.add_argument("--mode", choices=["legacy", "default", "inplace", "columns_only"], default=None, help="Run a single mode. By default every mode is run in its own process.")
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_mode(args.mode, args.rows, args.width)
+    else:
+        print("Peak RSS in MB for {} rows and {} float columns".format(args.rows, args.width))
+        print("{:<14}{:>12}{:>12}{:>12}".format("mode", "input", "peak", "added"))
+        # each mode runs in a fresh interpreter so peaks from one mode don't hide the next
+        for mode in ["legacy", "default", "inplace", "columns_only"]:
+            subprocess.check_call([sys.executable, __file__, "--mode", mode, "--rows", str(args.rows), "--width", str(args.width)])
@@ -0,0 +1,120 @@
+import argparse
+import gzip
+import json
+import os
+import sys
+import timeit
+import urllib.parse
+import urllib.request
+from cob_arcgis_geocoder.geocode import LEAN_OUTPUT_FIELDS
+
+CANDIDATES_URL = "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer/findAddressCandidates?{}"
+REVERSE_URL = "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer/reverseGeocode?{}"
+
+# request profiles compared by the benchmark: the previous pretty printed request for every field, and the lean one
+PROFILES = {"full": {"outFields": "*", "f": "pjson", "gzip": False},
+            "lean": {"outFields": LEAN_OUTPUT_FIELDS, "f": "json", "gzip": True}}
+
+DEFAULT_ADDRESSES = ["89 Orleans Street Boston MA, 02128",
+                     "51 Montebello Road Apt 2 Boston, MA 02130",
+                     "890 Commonwealth Avenue",
+                     "1 City Hall Plz, Boston, 02108",
+                     "100 Legends Way",
+                     "This isn't an address."]
+
+# x, y, input and output coordinate systems of the locations reverse geocoded in the tests
+DEFAULT_LOCATIONS = [(776969.460426, 2959300.669159480, 2249, 4326),
+                     (776969.460426, 2959300.669159480, 2249, 2249),
+                     (-71.057128, 42.360032, 4326, 4326),
+                     (-71.8023, 42.2626, 4326, 2249)]
+
+
+def record(addresses, responses_dir, locations=DEFAULT_LOCATIONS):
+    """Saves the response bodies for each address and profile, and for each location reverse geocoded, as they come over
+    the wire, and an index of the address or location each was recorded for."""
+
+    if not os.path.isdir(responses_dir):
+        os.makedirs(responses_dir)
+
+    index = []
+    for number, address in enumerate(addresses):
+        entry = {"address": address}
+        for profile, settings in PROFILES.items():
+            parameters = urllib.parse.urlencode({"Street": "", "SingleLine": address, "outSR": "4326", "outFields": settings["outFields"], "f": settings["f"]})
+            headers = {"Accept-Encoding": "gzip"} if settings["gzip"] else {}
+            with urllib.request.urlopen(urllib.request.Request(CANDIDATES_URL.format(parameters), headers=headers)) as url:
+                data = url.read()
+                content_encoding = url.headers.get("Content-Encoding") or ""
+
+            path = os.path.join(responses_dir, "{:04d}_{}.json{}".format(number, profile, ".gz" if content_encoding == "gzip" else ""))
+            with open(path, "wb") as f:
+                f.write(data)
+            entry[profile] = os.path.basename(path)
+            print("Recorded {} response for {} to {}".format(profile, address, path))
+        index.append(entry)
+
+    for number, (x, y, input_coord_system, output_coord_system) in enumerate(locations):
+        # the same parameters CobArcGISReverseGeocoder._reverse_geocode sends
+        location = {"x": x, "y": y, "spatialReference": {"wkid": input_coord_system}}
+        parameters = urllib.parse.urlencode({"location": location, "outSR": output_coord_system, "distance": 100, "returnIntersection": False, "f": "pjson"})
+        with urllib.request.urlopen(REVERSE_URL.format(parameters)) as url:
+            data = url.read()
+
+        path = os.path.join(responses_dir, "{:04d}_reverse.json".format(number))
+        with open(path, "wb") as f:
+            f.write(data)
+        index.append({"location": {"x": x, "y": y, "wkid": input_coord_system}, "outSR": output_coord_system, "reverse": os.path.basename(path)})
+        print("Recorded reverse geocode response for {}, {} to {}".format(x, y, path))
+
+    with open(os.path.join(responses_dir, "index.json"), "w", encoding="UTF-8") as f:
+        json.dump(index, f, indent=2)
+
+def _load_responses(responses_dir, profile):
+    """Returns the recorded response bodies of a profile as (is_gzipped, bytes) tuples."""
+
+    responses = []
+    for file_name in sorted(os.listdir(responses_dir)):
+        if "_{}.json".format(profile) in file_name:
+            with open(os.path.join(responses_dir, file_name), "rb") as f:
+                responses.append((file_name.endswith(".gz"), f.read()))
+    return responses
+
+def _decode(response):
+    is_gzipped, data = response
+    if is_gzipped:
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+def replay(responses_dir, repeat):
+    """Prints the bytes on the wire and the decode time per request for each profile."""
+
+    print("{:<8}{:>10}{:>16}{:>20}".format("profile", "requests", "bytes/request", "decode us/request"))
+    for profile in ["full", "lean"]:
+        responses = _load_responses(responses_dir, profile)
+        if len(responses) == 0:
+            print("No recorded {} responses in {}. Run with --record first.".format(profile, responses_dir))
+            sys.exit(1)
+
+        wire_bytes = sum(len(data) for _, data in responses) / float(len(responses))
+        seconds = min(timeit.repeat(lambda: [_decode(response) for response in responses], number=repeat, repeat=3))
+        print("{:<8}{:>10}{:>16.0f}{:>20.1f}".format(profile, len(responses), wire_bytes, seconds / repeat / len(responses) * 1e6))
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Compare bytes on the wire and decode time of the full and lean findAddressCandidates requests using recorded responses.")
+    parser.add_argument("responses_dir", help="Directory of responses recorded with --record. Only live responses give real bytes on the wire.")
+    parser.add_argument("--record", action="store_true", help="Record responses from the geocoder into responses_dir before comparing.")
+    parser.add_argument("--addresses", default=None, help="Text file with one address per line to record. Defaults to the addresses used in the tests.")
+    parser.add_argument("--repeat", type=int, default=200, help="Number of times each response is decoded. Defaults to 200.")
+    args = parser.parse_args()
+
+    if args.record:
+        if args.addresses is not None:
+            with open(args.addresses, encoding="UTF-8") as f:
+                addresses = [line.strip() for line in f if line.strip()]
+        else:
+            addresses = DEFAULT_ADDRESSES
+        record(addresses, args.responses_dir)
+
+    replay(args.responses_dir, args.repeat)
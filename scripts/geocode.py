@@ -1,35 +1,87 @@
 import pandas as pd 
 import urllib.parse
+import urllib.request
 import json
+import gzip
+import numbers
 from pandas.io.json import json_normalize
 import psycopg2
 import subprocess
 import os
 import codecs
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import sys
-from datetime import datetime
+import argparse
+import contextlib
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import threading
+import queue
+import time
+import re
+import hashlib
+from datetime import datetime, timedelta
+
+# base url of the geocode service, set ARCGIS_GEOCODER_URL to use another server such as scripts/stub_server.py
+GEOCODER_URL = os.environ.get("ARCGIS_GEOCODER_URL", "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer")
+
+# attributes requested for each candidate, address, score and location are always returned
+LEAN_OUTPUT_FIELDS = "Ref_ID,Loc_name"
+
+# columns added to the input with the geocoded address information
+RESULT_COLUMNS = ["matched_address", "matched_address_score", "SAM_ID", "location_x", "location_y", "flag", "locator_name"]
+
+# flags of rows that were geocoded, other rows are geocoded again when rerunning against a previous output
+GEOCODED_FLAGS = ["Able to geocode to a SAM address.", "Able to geocode to a non-SAM address."]
+
+# file formats recognised from the file extension
+FILE_FORMATS = {".csv": "csv", ".parquet": "parquet", ".pq": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+FILE_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+def geocode_df(df, address_field, result_store=None, previous_results=None, counts=None):
+    """Returned a geocoded dataframe.
 
-
-def geocode_df(df, address_field):
-    """Returned a geocoded dataframe."""
+    Args:
+        df (:obj:`dataframe`): Dataframe containing the addresses to geocode.
+        address_field (str): Name of the column holding the addresses.
+        result_store (:obj:`_ResultStore`, optional): On-disk store of previous results and failed addresses to check before calling ArcGIS.
+        previous_results (dict, optional): Results of a previous output keyed by address hash, carried forward instead of geocoding.
+        counts (dict, optional): Counter whose "requested" entry is increased for every address sent to ArcGIS.
+    """
     
-    # add columns for geocoded address information
-    df = pd.concat([df,pd.DataFrame(columns=["matched_address", "matched_address_score", "SAM_ID", "location_x", "location_y", "flag", "locator_name"])])
+    # add columns for geocoded address information, without concatenating so the input columns keep their types
+    df = df.copy()
+    for column in RESULT_COLUMNS:
+        if column not in df.columns:
+            df[column] = pd.Series(None, index=df.index, dtype=object)
     
     # Locators that return addresses with SAM IDs
     SAM_Locators = ["SAM_Sub_Unit_A", "SAM_Alternate"]
 
     # Iterate through each row and geocode the address
     for index, row in df.iterrows():
+
+        previous_result = previous_results.get(_address_hash(row[address_field])) if previous_results and row[address_field] is not None else None
+        known_failure = result_store.get_failure(row[address_field]) if result_store is not None and row[address_field] is not None and previous_result is None else None
         
         if row[address_field] is None: 
             # if address field is empty, add flag to row
             df.at[index, "flag"] = "No address provided. Unable to geocode."
+        elif previous_result is not None:
+            # if the address was geocoded in the previous output, carry the result forward
+            for column, value in zip(RESULT_COLUMNS, previous_result):
+                df.at[index, column] = value
+        elif known_failure is not None:
+            # if the address recently failed to geocode, flag it without sending it to ArcGIS again
+            df.at[index, "flag"] = "Unable to geocode to any address."
+            df.at[index, "location_x"] = 0.00
+            df.at[index, "location_y"] = 0.00
         else: 
             # if address field isn't empty, try geocoding:
             # 1. find the address candidates
-            candidates = _find_address_candidates(SingleLine=row[address_field])
+            candidates = _get_address_candidates(row[address_field], result_store, counts)
             # 2. pick the from the list of candidates
             matched_address_df = _pick_address_candidate(candidates, SAM_Locators)  
 
@@ -56,21 +108,202 @@ def geocode_df(df, address_field):
                 # Set lat/long to 0 if unable to geocode
                 df.at[index, "location_x"] = 0.00
                 df.at[index, "location_y"] = 0.00      
-                _archive_non_sam_address(row[address_field], None)
+                # errors that may pass, like an overloaded server, aren't stored so the address is tried again next run
+                returned_result = _failure_result(candidates)
+                if result_store is None or returned_result is None:
+                    _archive_non_sam_address(row[address_field], None)
+                # only archive the address again if it failed differently or wasn't archived the last time it was recorded
+                elif result_store.put_failure(row[address_field], returned_result) and _archive_non_sam_address(row[address_field], None):
+                    result_store.mark_failure_archived(row[address_field])
 
     # return the updated dataframe when the rows have been iterated through
     return df
 
+def _address_hash(address):
+    """Returns a hash of the address after normalizing its case, whitespace and punctuation."""
+
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", str(address)).upper().split())
+    return hashlib.sha1(normalized.encode("UTF-8")).digest()
+
+def _load_previous_results(file_path, address_field):
+    """Returns the results of a previous geocoded output keyed by address hash.
+
+    Only the address and result columns are read. Rows that failed to geocode are left out so they are tried again.
+
+    Args:
+        file_path (str): Path of the previous csv, Parquet or Arrow output.
+        address_field (str): Name of the column holding the addresses.
+
+    Returns:
+        dict: Tuples of the result columns for each address that was geocoded.
+    """
+
+    file_format = FILE_FORMATS.get(os.path.splitext(file_path)[1].lower())
+    if file_format is None:
+        print("Unsupported file extension for the previous output {}. Please use one of {}.".format(file_path, ", ".join(sorted(FILE_FORMATS))))
+        sys.exit(1)
+
+    previous_results = dict()
+    for chunk in _read_chunks(file_path, file_format, 50000, columns=[address_field] + RESULT_COLUMNS):
+        for address, values in zip(chunk[address_field], zip(*[chunk[column] for column in RESULT_COLUMNS])):
+            if pd.isnull(address) or values[5] not in GEOCODED_FLAGS:
+                continue
+            values = [None if pd.isnull(value) else value for value in values]
+            # SAM_ID is read as a float or a string like "32856.0" when the column has blanks, so turn it back into an int
+            try:
+                values[2] = _to_int(values[2])
+            except ValueError:
+                pass
+            previous_results[_address_hash(address)] = tuple(values)
+    return previous_results
+
+def _previous_results_for_chunk(chunk, address_field, previous_results):
+    """Returns the previous results for the addresses in a chunk and the number of rows they cover.
+
+    Only this subset is handed to a worker process, so the full set of previous results is never copied to them.
+    """
+
+    chunk_results = dict()
+    rows_reused = 0
+    for address in chunk[address_field]:
+        if address is None:
+            continue
+        address_hash = _address_hash(address)
+        if address_hash in previous_results:
+            chunk_results[address_hash] = previous_results[address_hash]
+            rows_reused += 1
+    return chunk_results, rows_reused
+
+class _ResultStore(object):
+    """On-disk sqlite store of address candidates and of addresses that failed to geocode.
+
+    The store can be opened by several worker processes at once, so an address geocoded by one worker is reused by the
+    others. Two workers that look up the same address before either has stored it will both send it to ArcGIS.
+    Failed addresses are kept for a shorter time than results so that fixes to the locators are picked up.
+
+    Args:
+        store_path (str): Path of the sqlite file. It is created if it doesn't exist.
+        ttl_days (int, optional): Number of days a stored result is reused before the address is geocoded again.
+        failure_ttl_days (int, optional): Number of days an address that failed is skipped before it is geocoded again.
+    """
+
+    def __init__(self, store_path, ttl_days=30, failure_ttl_days=7):
+        self.store_path = store_path
+        self.ttl = timedelta(days=ttl_days)
+        self.failure_ttl = timedelta(days=failure_ttl_days)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections are opened again in each worker process the store is sent to
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared between threads, so each geocoding thread opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.store_path, timeout=60)
+            # WAL lets readers in other workers continue while one worker is writing
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS address_candidates (address_submitted TEXT PRIMARY KEY, candidates TEXT, time_stamp TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS failed_addresses (address_submitted TEXT PRIMARY KEY, returned_result TEXT, time_stamp TEXT, archived INTEGER DEFAULT 0)")
+            # stores written before archived was tracked are treated as never archived
+            if "archived" not in [column[1] for column in conn.execute("PRAGMA table_info(failed_addresses)")]:
+                conn.execute("ALTER TABLE failed_addresses ADD COLUMN archived INTEGER DEFAULT 0")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def get(self, address):
+        """Returns the stored candidates for an address, or None if there are none newer than the TTL."""
+
+        oldest = (datetime.now() - self.ttl).isoformat()
+        row = self.conn.execute("SELECT candidates FROM address_candidates WHERE address_submitted = ? AND time_stamp >= ?", (address, oldest)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, address, candidates):
+        """Stores the candidates returned for an address."""
+
+        self.conn.execute("INSERT OR REPLACE INTO address_candidates (address_submitted, candidates, time_stamp) VALUES (?, ?, ?)", (address, json.dumps(candidates), datetime.now().isoformat()))
+        self.conn.commit()
+
+    def get_failure(self, address):
+        """Returns "error" or "empty" if the address failed to geocode within the failure TTL, otherwise None."""
+
+        oldest = (datetime.now() - self.failure_ttl).isoformat()
+        row = self.conn.execute("SELECT returned_result FROM failed_addresses WHERE address_submitted = ? AND time_stamp >= ?", (address, oldest)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_failure(self, address, returned_result):
+        """Records that an address failed to geocode.
+
+        Args:
+            address (str): The address that was geocoded.
+            returned_result (str): "error" if ArcGIS rejected the address with a 400 error, "empty" if it returned no candidates.
+
+        Returns:
+            bool: True if the address needs to be archived: it hadn't failed before, failed differently last time or wasn't archived.
+        """
+
+        row = self.conn.execute("SELECT returned_result, archived FROM failed_addresses WHERE address_submitted = ?", (address,)).fetchone()
+        # an archive is only still valid while the address keeps failing the same way
+        archived = 1 if row is not None and row[0] == returned_result and row[1] else 0
+        self.conn.execute("INSERT OR REPLACE INTO failed_addresses (address_submitted, returned_result, time_stamp, archived) VALUES (?, ?, ?, ?)", (address, returned_result, datetime.now().isoformat(), archived))
+        self.conn.commit()
+        return not archived
+
+    def mark_failure_archived(self, address):
+        """Records that a failed address was archived, so it isn't archived again until it fails differently."""
+
+        self.conn.execute("UPDATE failed_addresses SET archived = 1 WHERE address_submitted = ?", (address,))
+        self.conn.commit()
+
+def _get_address_candidates(SingleLine, result_store=None, counts=None):
+    """Returns address candidates from the result store if available, otherwise from ArcGIS.
+
+    Args:
+        SingleLine (str): The address to be geocoded.
+        result_store (:obj:`_ResultStore`, optional): Store of previous results.
+        counts (dict, optional): Counter whose "requested" entry is increased when ArcGIS is called.
+
+    Returns:
+        JSON: Object containing candidate addresses.
+    """
+
+    candidates = result_store.get(SingleLine) if result_store is not None else None
+    if candidates is not None:
+        return candidates
+
+    if counts is not None:
+        counts["requested"] = counts.get("requested", 0) + 1
+    candidates = _find_address_candidates(SingleLine=SingleLine)
+
+    # only keep results that found something, failed lookups are tried again on the next run
+    if result_store is not None and "candidates" in candidates and len(candidates["candidates"]) > 0:
+        result_store.put(SingleLine, candidates)
+
+    return candidates
+
 # input the given address to the ESRI ArcGIS geocoder, default output coordinate system is 4326
-def _find_address_candidates(SingleLine, Street="", coord_system="4326", outputFields="*", outputType="pjson"):
+def _find_address_candidates(SingleLine, Street="", coord_system="4326", outputFields=LEAN_OUTPUT_FIELDS, outputType="json"):
     """Returns a JSON object of address candidates.
     
     Args:
         SingleLine (str): Specifies the location to be geocoded. The input address components are formatted as a single string.
         Street (str, optional): The street address location to be geocoded.
         coord_system (str, optional): The well-known ID (WKID) of the spatial reference or a spatial reference JSON object for the returned address candidates.
-        outputFields (str, optional): The list of fields to be included in the returned result set. * returns all fields.
-        outputType (str, optional): The response format. The default response format is html.
+        outputFields (str, optional): The list of fields to be included in the returned result set. * returns all fields. Defaults to the fields the candidate is picked by.
+        outputType (str, optional): The response format. Defaults to compact json.
     
     Returns:
         JSON: Object containing candidate addresses.
@@ -82,11 +315,15 @@ def _find_address_candidates(SingleLine, Street="", coord_system="4326", outputF
                     "outFields": outputFields,
                     "f": outputType }
     parameters = urllib.parse.urlencode(parameters)
-    candidates_url = "https://awsgeo.boston.gov/arcgis/rest/services/Locators/Boston_Composite_Prod/GeocodeServer/findAddressCandidates?{}".format(parameters) 
-
-    with urllib.request.urlopen(candidates_url) as url:
-        data = url.read().decode("utf-8")
-        candidates = json.loads(data)
+    candidates_url = "{}/findAddressCandidates?{}".format(GEOCODER_URL, parameters) 
+
+    # ask for a gzipped response, the server sends it uncompressed if it can't
+    request = urllib.request.Request(candidates_url, headers={"Accept-Encoding": "gzip"})
+    with urllib.request.urlopen(request) as url:
+        data = url.read()
+        if url.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+    candidates = json.loads(data)
     
     # return the possible candidates as json
     return candidates
@@ -136,8 +373,26 @@ def _pick_address_candidate(candidates, locators):
         # if there were no candidates returned, return None so the row in the dataframe can be properly flagged
         return None
 
+def _failure_result(candidates):
+    """Returns how a lookup without a usable candidate failed, to record it in the result store.
+
+    Returns:
+        str: "empty" if ArcGIS returned no candidates, "error" if it rejected the address with a 400 error.
+        none: For any other error, such as a 5xx from an overloaded server, which may pass and isn't stored.
+    """
+
+    if "error" not in candidates:
+        return "empty"
+    if candidates["error"].get("code") == 400:
+        return "error"
+    return None
+
 def _archive_non_sam_address(address, returned_result):
-    """Uploads to a postgres table to keep track of addresses that need to be assigned a SAM ID."""
+    """Uploads to a postgres table to keep track of addresses that need to be assigned a SAM ID.
+
+    Returns:
+        bool: True if the address was archived, False if the environment variables are missing or the insert failed.
+    """
 
     env_var_dict = dict()
     env_var_dict['upload_hostname'] = os.environ.get("POSTGRES_IP")
@@ -150,7 +405,7 @@ def _archive_non_sam_address(address, returned_result):
     for _, v in env_var_dict.items():
         if v == None:
             print("Environment variables not found. Continuing...")
-            return
+            return False
 
     config_params = dict()
     config_params['upload_table_name'] = "internal_data.failed_geocoded_addresses"
@@ -178,37 +433,590 @@ def _archive_non_sam_address(address, returned_result):
             print("Incorrect status message from insert operation. Exiting. An error occured.")
             sys.exit(1)
 
+        return True
+
     except Exception as e:
         print("ERROR: Issue inserting data into the database. Exiting. Error: {}".format(str(e)))
+        return False
 
 
-if __name__=="__main__":
+def _detect_encoding(file_path):
+    """Returns the encoding to read the csv file with, UTF-8 if the whole file decodes as UTF-8 otherwise ANSI."""
 
-    if len(sys.argv) == 3:
-        file_path = sys.argv[1]
-        address_column = sys.argv[2]
-    else:
-        print(r'Please enter a valid csv file path and the name of the address column to geocode. Ex: python geocode.py "C:\Users\UserName\Desktop\address_list.csv" "address_column"')
-        print("File location: {}\nAddress column:{}".format(file_path, address_column))
+    decoder = codecs.getincrementaldecoder("UTF-8")()
+    with open(file_path, "rb") as f:
+        try:
+            # read in blocks so the whole file is never held in memory
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                decoder.decode(block)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError as e:
+            print(str(e), "Trying ANSI encoding...")
+            return "ANSI"
+    return "UTF-8"
+
+def _import_pyarrow():
+    """Returns the pyarrow module, exiting with a message if it isn't installed."""
+
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        print("pyarrow is required to read and write Parquet and Arrow files. Install it with `conda install pyarrow`. Exiting.")
         sys.exit(1)
+    return pyarrow
+
+def _read_chunks(file_path, file_format, chunk_size, columns=None, as_text=False):
+    """Yields the input file as dataframes of up to chunk_size rows.
+
+    Args:
+        file_path (str): Path of the file to read.
+        file_format (str): One of csv, parquet or arrow.
+        chunk_size (int): Number of rows per chunk.
+        columns (:obj:`list`, optional): Columns to read. For Parquet and Arrow the other columns are never loaded.
+        as_text (bool, optional): Read csv columns as text instead of inferring their types.
+    """
+
+    if file_format == "csv":
+        encoding = _detect_encoding(file_path)
+        for chunk in pd.read_csv(filepath_or_buffer=file_path, encoding=encoding, chunksize=chunk_size, usecols=columns, dtype=str if as_text else None):
+            yield chunk
+
+    elif file_format == "parquet":
+        pa = _import_pyarrow()
+        parquet_file = pa.parquet.ParquetFile(file_path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            # integer columns with nulls stay python ints instead of becoming float64
+            yield batch.to_pandas(integer_object_nulls=True)
+
+    else:
+        pa = _import_pyarrow()
+        # memory map the file so only the pages of the selected columns are read
+        with pa.memory_map(file_path) as source:
+            table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select(columns)
+            for batch in table.to_batches(max_chunksize=chunk_size):
+                yield batch.to_pandas(integer_object_nulls=True)
+
+def _input_fields(file_path, file_format, columns=None):
+    """Returns the arrow fields of the input columns, or None for csv input whose columns are written as text."""
+
+    if file_format == "csv":
+        return None
+
+    pa = _import_pyarrow()
+    if file_format == "parquet":
+        schema = pa.parquet.read_schema(file_path)
+    else:
+        with pa.memory_map(file_path) as source:
+            schema = pa.ipc.open_file(source).schema
+
+    names = columns if columns is not None else schema.names
+    return [schema.field(name) for name in names if name not in RESULT_COLUMNS]
+
+def _to_int(value, coerce=False):
+    """Returns the value as an int, or None if it is missing.
+
+    Args:
+        value: An int, a float or string holding a whole number, or a missing value.
+        coerce (bool, optional): Return None instead of raising for values that aren't whole numbers.
+
+    Raises:
+        ValueError: If the value isn't a whole number and coerce is False.
+    """
+
+    if value is None or pd.isnull(value):
+        return None
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    try:
+        if isinstance(value, str):
+            try:
+                # parse digits directly so large ids aren't rounded through a float
+                return int(value.strip())
+            except ValueError:
+                value = float(value)
+        if isinstance(value, numbers.Real) and float(value).is_integer():
+            return int(value)
+        raise ValueError("{} is not a whole number".format(value))
+    except ValueError:
+        if coerce:
+            return None
+        raise
+
+class _OutputWriter(object):
+    """Writes geocoded chunks to a csv, Parquet or Arrow IPC file as they complete.
+
+    Parquet and Arrow output is typed: coordinates and score are float64, SAM_ID is int64 or string and flag and
+    locator_name are dictionary encoded. Each chunk becomes its own Parquet row group or Arrow record batch.
+
+    Args:
+        path (str): Path of the output file.
+        file_format (str): One of csv, parquet or arrow.
+        input_fields (:obj:`list`, optional): Arrow fields of the input columns. Columns without a field are written as text.
+        sam_id_type (str, optional): Type of the SAM_ID column, int or string.
+    """
+
+    def __init__(self, path, file_format, input_fields=None, sam_id_type="int"):
+        self.path = path
+        self.file_format = file_format
+        self.input_fields = input_fields
+        self.sam_id_type = sam_id_type
+        self.schema = None
+        self.writer = None
+        self.sink = None
+        # values seen so far for each dictionary column, so every chunk only extends the dictionary
+        self.dictionaries = dict()
+
+    def write(self, df):
+        """Appends a geocoded dataframe to the output file."""
+
+        if self.file_format == "csv":
+            df.to_csv(self.path, mode="w" if self.schema is None else "a", header=self.schema is None, index=False, encoding="UTF-8")
+            self.schema = list(df.columns)
+            return
+
+        pa = _import_pyarrow()
+        if self.schema is None:
+            self.schema = self._build_schema(df)
+            if self.file_format == "parquet":
+                self.writer = pa.parquet.ParquetWriter(self.path, self.schema)
+            else:
+                self.sink = pa.OSFile(self.path, "wb")
+                self.writer = pa.ipc.new_file(self.sink, self.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+        self.writer.write_table(self._to_table(df))
+
+    def close(self):
+        """Finishes the output file."""
+
+        if self.writer is not None:
+            self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+    def _build_schema(self, df):
+        pa = _import_pyarrow()
+        input_fields = dict((field.name, field) for field in self.input_fields or [])
+        fields = []
+        for name in df.columns:
+            if name in RESULT_COLUMNS:
+                continue
+            field = input_fields.get(name, pa.field(name, pa.string()))
+            # only string dictionaries are kept encoded, other dictionary columns are written as their values
+            if pa.types.is_dictionary(field.type) and not pa.types.is_string(field.type.value_type):
+                field = pa.field(name, field.type.value_type)
+            fields.append(field)
+        fields += [pa.field("matched_address", pa.string()),
+                   pa.field("matched_address_score", pa.float64()),
+                   pa.field("SAM_ID", pa.int64() if self.sam_id_type == "int" else pa.string()),
+                   pa.field("location_x", pa.float64()),
+                   pa.field("location_y", pa.float64()),
+                   pa.field("flag", pa.dictionary(pa.int32(), pa.string())),
+                   pa.field("locator_name", pa.dictionary(pa.int32(), pa.string()))]
+        return pa.schema(fields)
+
+    def _to_table(self, df):
+        pa = _import_pyarrow()
+        arrays = []
+        for field in self.schema:
+            series = df[field.name]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(self._dictionary_encode(field, series))
+            elif pa.types.is_integer(field.type) and pd.api.types.is_integer_dtype(series.dtype):
+                # integer columns are converted as they are so values above 2**53 keep their precision
+                arrays.append(pa.array(series, from_pandas=True).cast(field.type))
+            elif pa.types.is_integer(field.type):
+                arrays.append(pa.array([_to_int(value, coerce=True) for value in series], type=pa.int64()).cast(field.type))
+            elif pa.types.is_floating(field.type):
+                arrays.append(pa.array(pd.to_numeric(series, errors="coerce").astype("float64"), from_pandas=True).cast(field.type))
+            elif pa.types.is_string(field.type):
+                arrays.append(pa.array([None if pd.isnull(value) else str(value) for value in series], type=pa.string()))
+            else:
+                arrays.append(pa.array(series, type=field.type, from_pandas=True))
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def _dictionary_encode(self, field, series):
+        pa = _import_pyarrow()
+        values = self.dictionaries.setdefault(field.name, OrderedDict())
+        indices = []
+        for value in series:
+            if pd.isnull(value):
+                indices.append(None)
+            else:
+                indices.append(values.setdefault(str(value), len(values)))
+        return pa.DictionaryArray.from_arrays(pa.array(indices, type=field.type.index_type), pa.array(list(values.keys()), type=pa.string()))
+
+def _geocode_shard(shard_path, output_path, address_field, result_store=None, previous_results=None):
+    """Geocodes one shard of the input file in a worker process and writes it to its own output file.
+
+    Args:
+        shard_path (str): Path of the pickled shard to geocode. It is removed once geocoded.
+        output_path (str): Path to pickle the geocoded shard to.
+        address_field (str): Name of the column holding the addresses.
+        result_store (:obj:`_ResultStore`, optional): Result store shared by all workers.
+        previous_results (dict, optional): Previous results for the addresses in this shard.
+
+    Returns:
+        tuple: Number of rows geocoded and number of addresses sent to ArcGIS.
+    """
+
+    # shards are pickled so column types survive the trip to the worker and back
+    df = pd.read_pickle(shard_path)
+    counts = {"requested": 0}
+    geocoded_df = geocode_df(df, address_field, result_store, previous_results, counts)
+    geocoded_df.to_pickle(output_path)
+    os.remove(shard_path)
+
+    return len(geocoded_df.index), counts["requested"]
+
+class _StageStats(object):
+    """Time a pipeline stage spent working and how full the queue it feeds was.
+
+    Args:
+        name (str): Name of the stage.
+        threads (int, optional): Number of threads running the stage.
+    """
+
+    def __init__(self, name, threads=1):
+        self.name = name
+        self.threads = threads
+        self.busy = 0.0
+        self.items = 0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.depth_max = 0
+        self.lock = threading.Lock()
+
+    def add_busy(self, seconds):
+        """Adds the time spent on one item."""
+
+        with self.lock:
+            self.busy += seconds
+            self.items += 1
+
+    def sample_depth(self, output_queue):
+        """Records the depth of the stage's output queue."""
+
+        depth = output_queue.qsize()
+        with self.lock:
+            self.depth_total += depth
+            self.depth_samples += 1
+            self.depth_max = max(self.depth_max, depth)
+
+    def report(self, wall_seconds):
+        """Prints the utilization of the stage and the depth of its output queue."""
+
+        utilization = self.busy / (wall_seconds * self.threads) if wall_seconds > 0 else 0.0
+        line = "{:<8} threads: {:<3} chunks: {:<6} busy: {:>8.1f}s utilization: {:>6.1%}".format(self.name, self.threads, self.items, self.busy, utilization)
+        # the last stage doesn't feed a queue
+        if self.depth_samples > 0:
+            line += " output queue depth avg: {:.1f} max: {}".format(self.depth_total / float(self.depth_samples), self.depth_max)
+        print(line)
+
+def _put(output_queue, item, stop):
+    """Puts an item on a queue, giving up if the pipeline is stopped while waiting for room."""
+
+    while not stop.is_set():
+        try:
+            output_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(input_queue, stop):
+    """Returns the next item on a queue, or None if the pipeline is stopped while waiting for one."""
+
+    while not stop.is_set():
+        try:
+            return input_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+def _timed(chunks, stage):
+    """Yields the chunks, adding the time taken to read each one to the stage."""
+
+    while True:
+        started = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        stage.add_busy(time.perf_counter() - started)
+        yield chunk
+
+def geocode_file(chunks, address_field, writer, result_store=None, previous_results=None, threads=1, queue_size=4, profiler=None):
+    """Geocodes the chunks of an input file in a pipeline of reading, geocoding and writing stages.
+
+    A reader thread parses chunks, geocoding threads send them to ArcGIS and the calling thread writes them out in
+    their original order. Bounded queues between the stages let them overlap while capping the chunks held in memory.
+    The utilization of each stage and the depth of the queues are printed at the end.
+
+    Args:
+        chunks (iterator): Dataframes returned by _read_chunks.
+        address_field (str): Name of the column holding the addresses.
+        writer (:obj:`_OutputWriter`): Writer for the output file.
+        result_store (:obj:`_ResultStore`, optional): Store of previous results and failed addresses.
+        previous_results (dict, optional): Results of a previous output returned by _load_previous_results.
+        threads (int, optional): Number of threads geocoding chunks at the same time.
+        queue_size (int, optional): Number of chunks each queue between stages holds.
+        profiler (:obj:`Profiler`, optional): Profiler to run the reading and geocoding threads under.
+
+    Returns:
+        tuple: Number of rows geocoded, number of rows carried forward from the previous output and number of addresses sent to ArcGIS.
+    """
+
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    # caps the chunks between the reader and the writer, so chunks waiting on a slow one can't pile up in the writer
+    in_flight = threading.BoundedSemaphore(2 * queue_size + threads)
+    stop = threading.Event()
+    errors = []
+    stats = OrderedDict([("read", _StageStats("read")), ("geocode", _StageStats("geocode", threads)), ("write", _StageStats("write"))])
+
+    def read():
+        profiling = contextlib.ExitStack()
+        try:
+            # started inside the stage so a profiler that fails to start stops the pipeline like any other error
+            if profiler is not None:
+                profiling.enter_context(profiler.thread_profile())
+            for chunk_number, chunk in enumerate(_timed(chunks, stats["read"])):
+                chunk_results, chunk_rows_reused = _previous_results_for_chunk(chunk, address_field, previous_results) if previous_results else (None, 0)
+                while not in_flight.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if not _put(read_queue, (chunk_number, chunk, chunk_results, chunk_rows_reused), stop):
+                    return
+                stats["read"].sample_depth(read_queue)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            profiling.close()
+            # one end marker per geocoding thread
+            for _ in range(threads):
+                _put(read_queue, None, stop)
+
+    def geocode():
+        profiling = contextlib.ExitStack()
+        try:
+            if profiler is not None:
+                profiling.enter_context(profiler.thread_profile())
+            while True:
+                item = _get(read_queue, stop)
+                if item is None:
+                    break
+                chunk_number, chunk, chunk_results, chunk_rows_reused = item
+                started = time.perf_counter()
+                counts = {"requested": 0}
+                geocoded_df = geocode_df(chunk, address_field, result_store, chunk_results, counts)
+                stats["geocode"].add_busy(time.perf_counter() - started)
+                if not _put(write_queue, (chunk_number, geocoded_df, chunk_rows_reused, counts["requested"]), stop):
+                    return
+                stats["geocode"].sample_depth(write_queue)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            profiling.close()
+            _put(write_queue, None, stop)
+
+    started = time.perf_counter()
+    stage_threads = [threading.Thread(target=read, name="geocode-read")]
+    stage_threads += [threading.Thread(target=geocode, name="geocode-{}".format(i)) for i in range(threads)]
+    for thread in stage_threads:
+        thread.daemon = True
+        thread.start()
+
+    # write the chunks out in order, holding on to the ones that finish early
+    row_count = 0
+    rows_reused = 0
+    rows_requested = 0
+    pending = dict()
+    next_chunk = 0
+    finished_threads = 0
+    try:
+        while finished_threads < threads:
+            item = _get(write_queue, stop)
+            if item is None:
+                if stop.is_set():
+                    break
+                finished_threads += 1
+                continue
+
+            chunk_number, geocoded_df, chunk_rows_reused, chunk_rows_requested = item
+            pending[chunk_number] = (geocoded_df, chunk_rows_reused, chunk_rows_requested)
+            while next_chunk in pending:
+                geocoded_df, chunk_rows_reused, chunk_rows_requested = pending.pop(next_chunk)
+                write_started = time.perf_counter()
+                writer.write(geocoded_df)
+                stats["write"].add_busy(time.perf_counter() - write_started)
+                row_count += len(geocoded_df.index)
+                rows_reused += chunk_rows_reused
+                rows_requested += chunk_rows_requested
+                next_chunk += 1
+                in_flight.release()
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+
+    for thread in stage_threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    wall_seconds = time.perf_counter() - started
+    print("Pipeline stages over {:.1f}s:".format(wall_seconds))
+    for stage in stats.values():
+        stage.report(wall_seconds)
+
+    return row_count, rows_reused, rows_requested
+
+def geocode_file_sharded(chunks, address_field, writer, processes, shard_dir, result_store=None, previous_results=None, max_shards=None):
+    """Geocodes the chunks of a large input file as row shards in worker processes.
+
+    Shards are written to shard_dir and handed to the workers as soon as they are read, so neither the parent nor a
+    worker holds more than one shard in memory. Once max_shards shards are in flight the oldest one is waited for and
+    written out before the next is read, so shard_dir never holds more than max_shards input and geocoded shards and
+    the output is written in the original row order while the workers keep going.
+
+    Args:
+        chunks (iterator): Dataframes returned by _read_chunks.
+        address_field (str): Name of the column holding the addresses.
+        writer (:obj:`_OutputWriter`): Writer for the output file.
+        processes (int): Number of worker processes.
+        shard_dir (str): Directory to write the shards to.
+        result_store (:obj:`_ResultStore`, optional): Store of previous results and failed addresses shared by all workers.
+        previous_results (dict, optional): Results of a previous output returned by _load_previous_results.
+        max_shards (int, optional): Number of shards submitted but not yet written out. Defaults to twice the number of processes.
+
+    Returns:
+        tuple: Number of rows geocoded, number of rows carried forward from the previous output and number of addresses sent to ArcGIS.
+    """
+
+    max_shards = max_shards or 2 * processes
+    row_count = 0
+    rows_reused = 0
+    rows_requested = 0
+    shards_written = 0
+
+    # a fresh worker per shard returns the memory used by each shard to the system
+    with multiprocessing.Pool(processes=processes, maxtasksperchild=1) as pool:
+        in_flight = deque()
+
+        def write_oldest():
+            nonlocal row_count, rows_requested, shards_written
+            result, output_path = in_flight.popleft()
+            shard_row_count, shard_rows_requested = result.get()
+            row_count += shard_row_count
+            rows_requested += shard_rows_requested
+            writer.write(pd.read_pickle(output_path))
+            os.remove(output_path)
+            shards_written += 1
+            print("Finished shard {}.".format(shards_written))
+
+        for shard_number, chunk in enumerate(chunks):
+            if len(in_flight) >= max_shards:
+                write_oldest()
+            shard_path = os.path.join(shard_dir, "shard_{:06d}.pkl".format(shard_number))
+            output_path = os.path.join(shard_dir, "shard_{:06d}_geocoded.pkl".format(shard_number))
+            chunk.to_pickle(shard_path)
+            chunk_results, chunk_rows_reused = _previous_results_for_chunk(chunk, address_field, previous_results) if previous_results else (None, 0)
+            rows_reused += chunk_rows_reused
+            in_flight.append((pool.apply_async(_geocode_shard, (shard_path, output_path, address_field, result_store, chunk_results)), output_path))
+
+        # write out the shards still running in order as they finish
+        while in_flight:
+            write_oldest()
+        print("Geocoded the input in {} shards.".format(shards_written))
+
+    return row_count, rows_reused, rows_requested
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Geocode the addresses in a csv, Parquet or Arrow file with the City of Boston ArcGIS geocoder.",
+                                     epilog=r'Ex: python geocode.py "C:\Users\UserName\Desktop\address_list.csv" "address_column"')
+    parser.add_argument("file_path", help="Full path of the csv, Parquet or Arrow file to geocode.")
+    parser.add_argument("address_column", help="Name of the address column to geocode.")
+    parser.add_argument("--output-format", choices=["csv", "parquet", "arrow"], default=None, help="Format of the output file. Defaults to the format of the input file.")
+    parser.add_argument("--address-only", action="store_true", help="Only read the address column, the other input columns aren't loaded or written.")
+    parser.add_argument("--sam-id-type", choices=["int", "string"], default="int", help="Type of the SAM_ID column in Parquet and Arrow output. Defaults to int.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes to geocode shards of the file with. Defaults to 1.")
+    parser.add_argument("--shard-size", type=int, default=50000, help="Number of rows each worker process geocodes at a time when using more than one process. Defaults to 50000.")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Number of rows read, geocoded and written at a time when using one process. Defaults to 1000.")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads geocoding chunks at the same time when using one process. Defaults to 1.")
+    parser.add_argument("--queue-size", type=int, default=4, help="Number of chunks held between the read, geocode and write stages. Defaults to 4.")
+    parser.add_argument("--result-store", default=None, help="Path of a sqlite file to store results in and reuse them from, shared across processes.")
+    parser.add_argument("--result-store-ttl", type=int, default=30, help="Number of days a stored result is reused. Defaults to 30.")
+    parser.add_argument("--failure-ttl", type=int, default=7, help="Number of days an address that failed to geocode is skipped before it is tried again. Defaults to 7.")
+    parser.add_argument("--profile", action="store_true", help="Profile the run and write cProfile stats, collapsed stacks for a flamegraph and a hot function summary next to the output file.")
+    parser.add_argument("--profile-top", type=int, default=25, help="Number of functions listed in the profile summary. Defaults to 25.")
+    parser.add_argument("--previous", default=None, help="Path of a previous geocoded output. Addresses geocoded in it are carried forward instead of being geocoded again.")
+    args = parser.parse_args()
+
+    file_path = args.file_path
+    address_column = args.address_column
 
     print("Starting geocode.py script for file: {} at {}.".format(file_path, datetime.now()))
     
     if os.path.isfile(file_path):
         file_name, file_extension = os.path.splitext(file_path)
-        try:
-            df = pd.read_csv(filepath_or_buffer=file_path, encoding="UTF-8")
-        except UnicodeDecodeError as e:
-            print(str(e), "Trying ANSI encoding...")
-            df = pd.read_csv(filepath_or_buffer=file_path, encoding="ANSI")
     else:
-        print("Please enter a full valid csv file path including .csv.\nFile path given: {}".format(file_path))
+        print("Please enter a full valid file path including the extension.\nFile path given: {}".format(file_path))
         sys.exit(1)
 
-    geocoded_df = geocode_df(df, address_column)
+    input_format = FILE_FORMATS.get(file_extension.lower())
+    if input_format is None:
+        print("Unsupported file extension {}. Please use one of {}.".format(file_extension, ", ".join(sorted(FILE_FORMATS))))
+        sys.exit(1)
+    output_format = args.output_format or input_format
+
+    output_file = "{}_geocoded_{}{}".format(file_name, datetime.now().strftime("%Y%M%d_%H%M%S"), file_extension if output_format == input_format else FILE_EXTENSIONS[output_format])
+
+    columns = [address_column] if args.address_only else None
+    # process shards are large so workers aren't started often, pipeline chunks are small so the stages overlap on small files
+    chunk_size = args.shard_size if args.processes > 1 else args.chunk_size
+    # csv columns are kept as text in typed output so every chunk has the same schema
+    chunks = _read_chunks(file_path, input_format, chunk_size, columns, as_text=input_format == "csv" and output_format != "csv")
+    writer = _OutputWriter(output_file, output_format, _input_fields(file_path, input_format, columns), args.sam_id_type)
+
+    result_store = _ResultStore(args.result_store, args.result_store_ttl, args.failure_ttl) if args.result_store else None
+
+    profiler = None
+    if args.profile:
+        # imported here so the package is only needed when profiling
+        from cob_arcgis_geocoder.profiling import Profiler
+        profiler = Profiler(output_file, top=args.profile_top)
+        if args.processes > 1:
+            print("Worker processes aren't profiled, only reading and writing are. Use --processes 1 to profile geocoding.")
 
-    csv_file = "{}_geocoded_{}{}".format(file_name, datetime.now().strftime("%Y%M%d_%H%M%S"), file_extension)
+    with contextlib.ExitStack() as stack:
+        if profiler is not None:
+            stack.enter_context(profiler)
+
+        previous_results = None
+        if args.previous is not None:
+            previous_results = _load_previous_results(args.previous, address_column)
+            print("Loaded {} geocoded addresses from the previous output {}.".format(len(previous_results), args.previous))
+
+        try:
+            if args.processes > 1:
+                shard_dir = tempfile.mkdtemp(prefix="geocode_shards_", dir=os.path.dirname(os.path.abspath(output_file)))
+                try:
+                    row_count, rows_reused, rows_requested = geocode_file_sharded(chunks, address_column, writer, args.processes, shard_dir, result_store, previous_results)
+                finally:
+                    shutil.rmtree(shard_dir, ignore_errors=True)
+            else:
+                row_count, rows_reused, rows_requested = geocode_file(chunks, address_column, writer, result_store, previous_results, args.threads, args.queue_size, profiler)
+        finally:
+            writer.close()
 
-    geocoded_df.to_csv(csv_file, index=False)
+    if previous_results is not None:
+        print("Reused {} rows from the previous output and requested {} of {} rows.".format(rows_reused, rows_requested, row_count))
 
     print("Finishing geocode.py script for file: {} at {}.".format(file_path, datetime.now()))
\ No newline at end of file
@@ -0,0 +1,124 @@
+import argparse
+import ast
+import gzip
+import json
+import os
+import re
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+# synthetic responses for the default addresses and locations of scripts/benchmark_requests.py, made to match the tests
+RESPONSES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "synthetic_responses")
+
+NO_CANDIDATES = b'{"spatialReference":{"wkid":4326,"latestWkid":4326},"candidates":[]}'
+
+# what ArcGIS answers for a location it can't find an address near
+NO_ADDRESS = b'{"error":{"code":400,"extendedCode":-2147467259,"message":"Unable to complete operation.","details":["Unable to find address for the specified location."]}}'
+
+
+def _location_key(x, y, wkid, out_sr):
+    """Returns the key a reverse geocoded location is replayed by, rounded so the same coordinates always match."""
+
+    return (round(float(x), 6), round(float(y), 6), str(wkid), str(out_sr))
+
+def _parse_location(location):
+    """Returns the x, y and wkid of a reverseGeocode location parameter.
+
+    CobArcGISReverseGeocoder sends the location as the repr of a python dict, so it is parsed as a python literal.
+    Numpy scalars like np.float64(1.5) are unwrapped first.
+    """
+
+    location = ast.literal_eval(re.sub(r"np\.\w+\(([^()]*)\)", r"\1", location))
+    return location["x"], location["y"], location.get("spatialReference", {}).get("wkid", 4326)
+
+
+class StubGeocodeServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the ArcGIS geocode service that replays recorded findAddressCandidates and reverseGeocode responses.
+
+    Responses are the ones recorded by scripts/benchmark_requests.py, or the synthetic ones in scripts/synthetic_responses,
+    and are looked up through their index.json: lean responses by the address they were recorded for, reverse geocode
+    responses by location and output coordinate system. Addresses that weren't recorded get no candidates and locations
+    that weren't recorded get ArcGIS's error for a location without an address.
+
+    Args:
+        server_address (tuple): Host and port to listen on.
+        responses_dir (str): Directory of recorded responses.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, responses_dir):
+        self.candidates = dict()
+        self.reverse = dict()
+        with open(os.path.join(responses_dir, "index.json"), encoding="UTF-8") as f:
+            index = json.load(f)
+        for entry in index:
+            if "lean" in entry:
+                self.candidates[entry["address"]] = self._load(responses_dir, entry["lean"])
+            if "reverse" in entry:
+                location = entry["location"]
+                key = _location_key(location["x"], location["y"], location["wkid"], entry["outSR"])
+                self.reverse[key] = self._load(responses_dir, entry["reverse"])
+        HTTPServer.__init__(self, server_address, _StubHandler)
+
+    @staticmethod
+    def _load(responses_dir, file_name):
+        with open(os.path.join(responses_dir, file_name), "rb") as f:
+            data = f.read()
+        # keep every response uncompressed and gzip it again only for clients that ask
+        return gzip.decompress(data) if file_name.endswith(".gz") else data
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parameters = parse_qs(url.query)
+
+        if url.path.endswith("/findAddressCandidates"):
+            address = parameters.get("SingleLine", [""])[0]
+            data = self.server.candidates.get(address, NO_CANDIDATES)
+        elif url.path.endswith("/reverseGeocode"):
+            try:
+                x, y, wkid = _parse_location(parameters["location"][0])
+                key = _location_key(x, y, wkid, parameters.get("outSR", ["4326"])[0])
+            except (KeyError, ValueError, SyntaxError):
+                self.send_error(400, "Invalid location")
+                return
+            data = self.server.reverse.get(key, NO_ADDRESS)
+        else:
+            self.send_error(404, "The stub server only answers findAddressCandidates and reverseGeocode")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            data = gzip.compress(data)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep the output of profiled runs free of a line per request
+        pass
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Serve recorded geocoder responses locally so geocoding runs can be profiled reproducibly.",
+                                     epilog="Point the geocoder at it with ARCGIS_GEOCODER_URL=http://localhost:8000/GeocodeServer")
+    parser.add_argument("responses_dir", nargs="?", default=RESPONSES_DIR, help="Directory of responses recorded with scripts/benchmark_requests.py --record. Defaults to the synthetic responses in scripts/synthetic_responses.")
+    parser.add_argument("--host", default="localhost", help="Host to listen on. Defaults to localhost.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on. Defaults to 8000.")
+    args = parser.parse_args()
+
+    if not os.path.isfile(os.path.join(args.responses_dir, "index.json")):
+        print("Please enter a directory of responses recorded with scripts/benchmark_requests.py --record.\nDirectory given: {}".format(args.responses_dir))
+        sys.exit(1)
+
+    server = StubGeocodeServer((args.host, args.port), args.responses_dir)
+    print("Serving {} recorded addresses and {} recorded locations at http://{}:{}/GeocodeServer".format(len(server.candidates), len(server.reverse), args.host, args.port))
+    server.serve_forever()